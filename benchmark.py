@@ -0,0 +1,475 @@
+import sys
+import os
+import subprocess
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import http.server
+
+
+#####################################################################
+## Constants
+#####################################################################
+TEXT_INDENT = " - "
+OPTION_ACCOUNTS = "--accounts"
+OPTION_DOCS = "--docs"
+OPTION_DOC_SIZE = "--doc-size"
+OPTION_LATENCY = "--latency"
+OPTION_PAGE_SIZE = "--page-size"
+OPTION_SET = "--set"
+OPTION_KEEP = "--keep"
+DEFAULT_ACCOUNTS = 500
+DEFAULT_DOCS = 400
+DEFAULT_DOC_SIZE = 50000
+DEFAULT_LATENCY = 50
+DEFAULT_PAGE_SIZE = 200
+BENCHMARK_TOKEN = "benchmark"
+SFDC_API_VERSION = "v59.0"
+SEARCH_TERMS = [ "kubernetes", "Ansible", "OpenShift", "école", "STRASSE", "ai", "&" ]
+CORPUS_WORDS = ("the plan for this account covers renewal pipeline budget timeline stakeholders risks "
+    + "kubernetes openshift ansible automation rhel cloud migration platform edge ai école straße").split()
+PARSE_RUNS = 3
+METRICS_FILENAME = "metrics.json"
+SEARCH_OPTION_FORMAT = "--format"
+CONFIG_KEY_REPORT_FORMAT = "REPORT_FORMAT"
+DEFAULT_REPORT_FORMAT = "csv"
+
+
+#####################################################################
+## Main Logic
+#####################################################################
+def main():
+    print("benchmark.py")
+    print()
+
+    print ("Usage: benchmark.py [--accounts <n>] [--docs <n>] [--doc-size <bytes>] [--latency <ms>] [--page-size <n>] [--set KEY=VALUE ...] [--keep] [-- search.py options]")
+    print ("Runs search.py against a local fake Quip API and Salesforce REST server, once with an empty cache and once warm")
+    print ("--accounts <n> number of accounts the SOQL query returns")
+    print ("--docs <n> number of distinct Quip documents the accounts link to")
+    print ("--doc-size <bytes> approximate size of each document's HTML")
+    print ("--latency <ms> delay the fake Quip server adds to every request")
+    print ("--page-size <n> records per page of SOQL results")
+    print ("--set KEY=VALUE adds a setting to search.py's settings file, e.g. --set CACHE_BACKEND=blobs")
+    print ("--keep leaves the temporary directory in place for inspection")
+    print ()
+
+    options, settings, searchArgs = parse_options(sys.argv[1:])
+    accounts = int(options.get(OPTION_ACCOUNTS, DEFAULT_ACCOUNTS))
+    docs = int(options.get(OPTION_DOCS, DEFAULT_DOCS))
+    docSize = int(options.get(OPTION_DOC_SIZE, DEFAULT_DOC_SIZE))
+    latency = int(options.get(OPTION_LATENCY, DEFAULT_LATENCY)) / 1000.0
+    pageSize = int(options.get(OPTION_PAGE_SIZE, DEFAULT_PAGE_SIZE))
+
+    print ("Generating " + str(docs) + " documents of about " + str(docSize) + " bytes...")
+    corpus = Corpus(accounts, docs, docSize)
+
+    server = FakeServer(corpus, latency, pageSize)
+    server.start()
+
+    workDir = tempfile.mkdtemp(prefix="ap-search-benchmark-")
+    try:
+        write_settings(workDir, server.url, settings)
+
+        results = []
+        for run in [ "cold", "warm" ]:
+            print ("Running search.py (" + run + " cache)...")
+            results.append(run_search(workDir, server, run, searchArgs, get_report_format(searchArgs, settings)))
+
+        print ()
+        print ("Timing text extraction and matching in-process...")
+        parseResults = time_parsing(corpus)
+    finally:
+        server.stop()
+        if (OPTION_KEEP in options):
+            print ("Kept " + workDir)
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    print ()
+    print ("Accounts=" + str(accounts) + " Docs=" + str(docs) + " DocSize=" + str(docSize) + " Latency=" + str(int(latency * 1000)) + "ms")
+    print ()
+    print ("%-6s %9s %9s %9s %9s %9s %9s %11s %10s %11s" % ("run", "wall s", "docs/s", "requests", "fetched", "p50 ms", "p99 ms", "server p50", "extract s", "peak RSS MB"))
+    for r in results:
+        print ("%-6s %9.2f %9.1f %9d %9d %9.1f %9.1f %11.1f %10.2f %11.1f" % (r["run"], r["wall"], docs / r["wall"], r["requests"], r["fetched"],
+            r["p50"] * 1000, r["p99"] * 1000, r["serverP50"] * 1000, r["extract"], r["rss"] / 1024.0 / 1024.0))
+    print ()
+    print ("%-8s %12s %12s %12s" % ("parser", "parse ms/doc", "parse MB/s", "match ms/doc"))
+    for r in parseResults:
+        print ("%-8s %12.3f %12.1f %12.3f" % (r["extractor"], r["parse"] * 1000, r["mbps"], r["match"] * 1000))
+
+    if (results[0]["report"] != results[1]["report"]):
+        print ()
+        print ("WARNING: cold and warm runs produced different reports!")
+        sys.exit(1)
+
+
+#####################################################################
+## Runs search.py once as a child process and measures it.  The
+## child is reaped with wait4() so its peak RSS is its own and not
+## the largest of every child so far.
+#####################################################################
+def run_search(workDir, server, run, searchArgs, reportFormat):
+    server.reset_stats()
+
+    env = dict(os.environ)
+    env["HOME"] = workDir
+    command = [ sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "search.py") ] + searchArgs
+
+    logFilename = os.path.join(workDir, run + ".log")
+    with open(logFilename, "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if (process.returncode != 0):
+        print ("search.py failed!  Return Code=" + str(process.returncode) + " Log=" + logFilename)
+        with open(logFilename, "r") as log:
+            print (log.read()[-2000:])
+        sys.exit(1)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = usage.ru_maxrss if (sys.platform == "darwin") else usage.ru_maxrss * 1024
+
+    with open(os.path.join(workDir, "cache", "report." + reportFormat), "rb") as f:
+        report = f.read()
+
+    # fetch latency is what search.py saw for each Quip request, which
+    # includes any pacing and retries on top of the server's own time
+    with open(os.path.join(workDir, "cache", METRICS_FILENAME), "r") as f:
+        stages = json.load(f)["stages"]
+    requests = stages.get("quip_request", { "p50": 0.0, "p99": 0.0 })
+
+    return {
+        "run": run,
+        "wall": wall,
+        "requests": server.requests,
+        "fetched": server.fetched,
+        "p50": requests["p50"],
+        "p99": requests["p99"],
+        "serverP50": percentile(server.get_latencies(), 50),
+        "extract": stages.get("extract", { "seconds": 0.0 })["seconds"],
+        "rss": rss,
+        "report": report
+    }
+
+
+#####################################################################
+## Times every available text extractor over the corpus, along with
+## term matching on the extracted text
+#####################################################################
+def time_parsing(corpus):
+    import search
+
+    matcher = search.TermMatcher(SEARCH_TERMS)
+    results = []
+    for extractor in [ search.TEXT_EXTRACTOR_STREAM, search.TEXT_EXTRACTOR_LXML, search.TEXT_EXTRACTOR_SOUP ]:
+        try:
+            textExtractor = search.get_text_extractor({ search.CONFIG_KEY_TEXT_EXTRACTOR: extractor })
+            textExtractor("<p></p>")
+        except (search.SearchError, ImportError):
+            print (TEXT_INDENT + extractor + " is not installed, skipping")
+            continue
+
+        parseTime = None
+        matchTime = None
+        for i in range(PARSE_RUNS):
+            start = time.perf_counter()
+            texts = [search.extract_text(textExtractor, html) for html in corpus.html]
+            elapsed = time.perf_counter() - start
+            parseTime = elapsed if (parseTime == None) else min(parseTime, elapsed)
+
+            start = time.perf_counter()
+            for text in texts:
+                matcher.count(text)
+            elapsed = time.perf_counter() - start
+            matchTime = elapsed if (matchTime == None) else min(matchTime, elapsed)
+
+        results.append({
+            "extractor": extractor,
+            "parse": parseTime / len(corpus.html),
+            "mbps": corpus.bytes / parseTime / 1024.0 / 1024.0,
+            "match": matchTime / len(corpus.html)
+        })
+
+    return results
+
+
+#####################################################################
+## Nearest-rank percentile of a list of numbers
+#####################################################################
+def percentile(values, p):
+    if (len(values) == 0):
+        return 0.0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+#####################################################################
+## Writes the search.py settings file into the temporary HOME
+#####################################################################
+def write_settings(workDir, serverUrl, settings):
+    config = dict()
+    config["QUIP_ACCESS_TOKEN"] = BENCHMARK_TOKEN
+    config["QUIP_URL_STRIP"] = "https://quip.com/"
+    config["QUIP_BASE_URL"] = serverUrl
+    config["SFDC_USERNAME"] = BENCHMARK_TOKEN
+    config["SFDC_QUERY"] = "SELECT Id, Name, Sub_Region__c, Account_Plan_URL__c, CS_Plan_URL__c FROM Account"
+    config["SFDC_SOURCE"] = "rest"
+    config["SFDC_INSTANCE_URL"] = serverUrl
+    config["SFDC_ACCESS_TOKEN"] = BENCHMARK_TOKEN
+    config["KEYWORDS"] = ",".join(SEARCH_TERMS)
+    config["MAX_RESULTS"] = "0"
+    config["CACHE_DIR"] = os.path.join(workDir, "cache")
+    config.update(settings)
+
+    os.makedirs(config["CACHE_DIR"], exist_ok=True)
+    with open(os.path.join(workDir, ".search.py.settings"), "w") as f:
+        for key, value in config.items():
+            f.write(key + "=" + value + "\n")
+
+
+#####################################################################
+## Synthetic accounts and Quip documents.  Documents are built from a
+## seeded word list, so every run of the benchmark sees the same
+## corpus, and mix the markup search.py has to cope with: headings,
+## lists, tables, entities, comments, scripts and styles.  Accounts
+## link an account plan and a CS plan each, some of them shared.
+#####################################################################
+class Corpus:
+    def __init__(self, accounts, docs, docSize):
+        self.docIds = [ "bench%05d" % i for i in range(docs) ]
+        self.html = [ self.generate_html(i, docSize) for i in range(docs) ]
+        self.bytes = sum(len(h.encode("utf-8")) for h in self.html)
+        self.threads = dict()
+        for i in range(docs):
+            self.threads[self.docIds[i]] = {
+                "thread": {
+                    "id": "T" + self.docIds[i],
+                    "title": "Plan " + str(i),
+                    "link": "https://quip.com/" + self.docIds[i],
+                    "updated_usec": 1600000000000000 + i
+                },
+                "html": self.html[i]
+            }
+
+        self.records = []
+        for i in range(accounts):
+            self.records.append({
+                "attributes": { "type": "Account" },
+                "Id": "001BENCH%07d" % i,
+                "Name": "Account " + str(i) + ", Inc.",
+                "Sub_Region__c": [ "East", "West", "Central" ][i % 3],
+                "Account_Plan_URL__c": "https://quip.com/" + self.docIds[i % docs] + "/Account-Plan",
+                "CS_Plan_URL__c": "https://quip.com/" + self.docIds[(i * 7 + 3) % docs] if (i % 4) else None
+            })
+
+    def generate_html(self, i, docSize):
+        rnd = random.Random(i)
+        parts = [ "<h1>Account Plan " + str(i) + "</h1>", "<style>p { margin: 0 }</style>", "<script>var kubernetes = 1;</script>" ]
+        size = sum(len(p) for p in parts)
+        while (size < docSize):
+            kind = rnd.random()
+            words = " ".join(rnd.choice(CORPUS_WORDS) for w in range(rnd.randint(8, 40)))
+            if (kind < 0.6):
+                part = "<p>" + words + " &amp; <b>" + rnd.choice(CORPUS_WORDS) + "</b></p>"
+            elif (kind < 0.75):
+                part = "<ul>" + "".join("<li>" + w + "</li>" for w in words.split()[:5]) + "</ul>"
+            elif (kind < 0.9):
+                part = "<table><tr><td>" + "</td><td>".join(words.split()[:4]) + "</td></tr></table>"
+            else:
+                part = "<h2>" + words[:40] + "</h2><!-- " + words[:20] + " --><br/>"
+            parts.append(part)
+            size = size + len(part)
+        return "".join(parts)
+
+
+#####################################################################
+## Fake Quip API and Salesforce REST server on a background thread.
+## Quip requests sleep for the configured latency before answering,
+## and the time taken to serve each document request is recorded to
+## compare against the latency search.py reports.
+#####################################################################
+class FakeServer:
+    def __init__(self, corpus, latency, pageSize):
+        self.corpus = corpus
+        self.latency = latency
+        self.pageSize = pageSize
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+        fakeServer = self
+        class Handler(FakeRequestHandler):
+            server_state = fakeServer
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:" + str(self.httpd.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.fetched = 0
+            self.latencies = []
+
+    def record(self, fetched, latency):
+        with self.lock:
+            self.requests = self.requests + 1
+            self.fetched = self.fetched + fetched
+            if (latency != None):
+                self.latencies.append(latency)
+
+    def get_latencies(self):
+        with self.lock:
+            return list(self.latencies)
+
+
+class FakeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server_state = None
+
+    def log_message(self, format, *args):
+        return
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        start = time.perf_counter()
+        state = self.server_state
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+
+        if (path.startswith("/services/data/")):
+            self.send_soql_page(url)
+            state.record(0, None)
+            return
+
+        time.sleep(state.latency)
+        if (path == "/1/users/current"):
+            self.send_json(200, { "id": BENCHMARK_TOKEN, "name": "Benchmark" })
+            state.record(0, None)
+        elif (path.startswith("/1/threads/")):
+            thread = state.corpus.threads.get(path[len("/1/threads/"):])
+            if (thread == None):
+                self.send_json(404, { "error_code": 404, "error_description": "Not found" })
+            else:
+                self.send_json(200, thread)
+            state.record(1, time.perf_counter() - start)
+        elif (path.startswith("/2/threads/")):
+            thread = state.corpus.threads.get(path[len("/2/threads/"):])
+            if (thread == None):
+                self.send_json(404, { "error_code": 404, "error_description": "Not found" })
+            else:
+                self.send_json(200, { "thread": thread["thread"] })
+            state.record(0, time.perf_counter() - start)
+        else:
+            self.send_json(404, { "error_code": 404, "error_description": "Not found" })
+            state.record(0, None)
+
+    def do_POST(self):
+        start = time.perf_counter()
+        state = self.server_state
+        length = int(self.headers.get("Content-Length", 0))
+        args = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+
+        time.sleep(state.latency)
+        if (urllib.parse.urlsplit(self.path).path == "/1/threads/"):
+            ids = args.get("ids", [ "" ])[0].split(",")
+            threads = dict((i, state.corpus.threads[i]) for i in ids if i in state.corpus.threads)
+            self.send_json(200, threads)
+            state.record(len(threads), time.perf_counter() - start)
+        else:
+            self.send_json(404, { "error_code": 404, "error_description": "Not found" })
+            state.record(0, None)
+
+    # SOQL results are paged like the REST query API, with
+    # nextRecordsUrl pointing at the next page's offset
+    def send_soql_page(self, url):
+        state = self.server_state
+        records = state.corpus.records
+        start = 0
+        if (not url.path.endswith("/query")):
+            start = int(url.path.rsplit("-", 1)[1])
+
+        end = start + state.pageSize
+        page = { "totalSize": len(records), "done": end >= len(records), "records": records[start:end] }
+        if (not page["done"]):
+            page["nextRecordsUrl"] = "/services/data/" + SFDC_API_VERSION + "/query/01gBENCH-" + str(end)
+        self.send_json(200, page)
+
+
+#####################################################################
+## Parse command line options.  Anything after "--" is passed on to
+## search.py.
+#####################################################################
+def parse_options(args):
+    options = dict()
+    settings = dict()
+    searchArgs = []
+
+    i = 0
+    while (i < len(args)):
+        arg = args[i]
+        if (arg == "--"):
+            searchArgs = args[i + 1:]
+            break
+        elif (arg == OPTION_KEEP):
+            options[arg] = True
+            i += 1
+        elif (arg in [ OPTION_ACCOUNTS, OPTION_DOCS, OPTION_DOC_SIZE, OPTION_LATENCY, OPTION_PAGE_SIZE, OPTION_SET ]):
+            if (i + 1 >= len(args)):
+                print ("Option requires a value: " + arg)
+                sys.exit(1)
+            if (arg == OPTION_SET):
+                tokens = args[i + 1].split("=", 1)
+                if (len(tokens) != 2):
+                    print ("Invalid setting!  Expected K=V and received: " + args[i + 1])
+                    sys.exit(1)
+                settings[tokens[0].strip()] = tokens[1].strip()
+            else:
+                options[arg] = args[i + 1]
+            i += 2
+        else:
+            print ("Unknown option: " + arg)
+            sys.exit(1)
+
+    return options, settings, searchArgs
+
+
+#####################################################################
+## Returns the format search.py writes its report in, from --format
+## among its options or else REPORT_FORMAT among the settings
+#####################################################################
+def get_report_format(searchArgs, settings):
+    for i in range(len(searchArgs) - 1):
+        if (searchArgs[i] == SEARCH_OPTION_FORMAT):
+            return searchArgs[i + 1].strip()
+    return settings.get(CONFIG_KEY_REPORT_FORMAT, DEFAULT_REPORT_FORMAT).strip()
+
+
+#####################################################################
+##  Program Entry Point
+#####################################################################
+if __name__ == "__main__":
+    main()
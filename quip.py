@@ -21,7 +21,7 @@ Typical usage:
     client = quip.QuipClient(access_token=...)
     user = client.get_authenticated_user()
     starred = client.get_folder(user["starred_folder_id"])
-    print "There are", len(starred["children"]), "items in your starred folder"
+    print("There are", len(starred["children"]), "items in your starred folder")
 
 In addition to standard getters and setters, we provide a few convenience
 methods for document editing. For example, you can use `add_to_first_list`
@@ -29,46 +29,29 @@ to append items (in Markdown) to the first bulleted or checklist in a
 given document, which is useful for automating a task list.
 """
 
+import base64
 import datetime
+import io
 import json
 import logging
+import random
 import ssl
-import sys
+import threading
 import time
 import xml.etree.cElementTree
 
-PY3 = sys.version_info > (3,)
+import http.client as httplib
+import urllib.request
+import urllib.parse
+import urllib.error
 
-if PY3:
-    import urllib.request
-    import urllib.parse
-    import urllib.error
-
-    Request = urllib.request.Request
-    urlencode = urllib.parse.urlencode
-    urlopen = urllib.request.urlopen
-    HTTPError = urllib.error.HTTPError
-
-    iteritems = dict.items
-
-else:
-    import urllib
-    import urllib2
-
-    Request = urllib2.Request
-    urlencode = urllib.urlencode
-    urlopen = urllib2.urlopen
-    HTTPError = urllib2.HTTPError
-
-    iteritems = dict.iteritems
+Request = urllib.request.Request
+urlsplit = urllib.parse.urlsplit
+urlencode = urllib.parse.urlencode
+urlopen = urllib.request.urlopen
+HTTPError = urllib.error.HTTPError
 
-
-try:
-    reload(sys)
-    sys.setdefaultencoding('utf8')
-except:
-    # Can't change default encoding usually...
-    pass
+iteritems = dict.items
 
 try:
     ssl.PROTOCOL_TLSv1_1
@@ -103,6 +86,210 @@ class QuipError(Exception):
         self.http_error = http_error
 
 
+def _get_proxy(url):
+    """Returns the `(host, port)` of the proxy set in the environment for the
+    given split URL, or None, along with the headers the proxy needs."""
+    proxy = urllib.request.getproxies().get(url.scheme)
+    if not proxy or urllib.request.proxy_bypass(url.hostname):
+        return None, {}
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    proxy = urlsplit(proxy)
+    headers = {}
+    if proxy.username:
+        credentials = "%s:%s" % (urllib.parse.unquote(proxy.username),
+                                 urllib.parse.unquote(proxy.password or ""))
+        headers["Proxy-Authorization"] = "Basic " + \
+            base64.b64encode(credentials.encode()).decode("ascii")
+    return (proxy.hostname,
+            proxy.port or (443 if proxy.scheme == "https" else 80)), headers
+
+
+class _ConnectionPool(object):
+    """A thread-safe pool of keep-alive HTTP/1.1 connections to one host.
+
+    Connections are handed out one request at a time and returned to the
+    pool afterwards, so a client shared between threads pays the TCP and
+    TLS handshake once per connection rather than once per request.
+
+    Like `urlopen`, connections go through the proxy set in the
+    environment (`https_proxy`, `http_proxy`, `no_proxy`), tunnelling
+    HTTPS through it with CONNECT.
+    """
+
+    def __init__(self, base_url, timeout):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port
+        self.secure = url.scheme == "https"
+        self.timeout = timeout
+        self.proxy, self.proxy_headers = _get_proxy(url)
+        self.path_prefix = ""
+        self._idle = []
+        self._lock = threading.Lock()
+
+        if self.proxy is not None and not self.secure:
+            # A plain HTTP proxy is sent the whole URL
+            self.path_prefix = "http://" + url.netloc.rpartition("@")[2]
+
+    def request(self, method, path, headers, body=None):
+        """Sends a request and returns `(status, reason, headers, body)`."""
+        if self.path_prefix:
+            path = self.path_prefix + path
+            headers = dict(headers, **self.proxy_headers)
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is not None:
+            # The server may have closed an idle connection since it was
+            # last used, in which case we retry once on a fresh one. Only
+            # the errors of a dropped connection count, so a request that
+            # timed out, and may have been handled, is never sent twice
+            try:
+                return self._request(connection, method, path, headers, body)
+            except (httplib.RemoteDisconnected, httplib.BadStatusLine,
+                    ConnectionResetError, BrokenPipeError):
+                pass
+        return self._request(
+            self._connect(), method, path, headers, body)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _connect(self):
+        if self.proxy is None:
+            host, port = self.host, self.port
+        else:
+            host, port = self.proxy
+        if self.secure:
+            connection = httplib.HTTPSConnection(
+                host, port, timeout=self.timeout,
+                context=ssl.create_default_context())
+            if self.proxy is not None:
+                connection.set_tunnel(
+                    self.host, self.port, headers=self.proxy_headers)
+            return connection
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _request(self, connection, method, path, headers, body):
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response_body = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._idle.append(connection)
+        return response.status, response.reason, response.msg, response_body
+
+
+class _RequestScheduler(object):
+    """Paces requests to stay just below Quip's rate limits and decides when
+    failed requests are retried.
+
+    Quip reports the remaining request budget in the X-Ratelimit-* (per
+    user) and X-Company-RateLimit-* (per company) response headers. The
+    scheduler runs a token bucket whose rate spreads the remaining budget
+    evenly over the time left until the limit resets, keeping `headroom`
+    of it in reserve, and stops issuing requests entirely once a budget is
+    exhausted. Until the first headers arrive requests are not throttled.
+
+    Retryable responses are retried up to `max_retries` times with jittered
+    exponential backoff, honoring Retry-After when the server sends it.
+    A 429 pauses every request sharing the scheduler, not just the one that
+    received it.
+    """
+    RATE_LIMIT_HEADERS = ("x-ratelimit-", "x-company-ratelimit-")
+    # Quip did not process these requests, so it is safe to retry any method
+    RETRY_ALWAYS = (429, 503)
+    # These may have been processed, so they are only retried for reads
+    RETRY_IDEMPOTENT = (500, 502, 504)
+
+    def __init__(self, max_retries=5, headroom=0.1, backoff_base=1.0,
+                 backoff_max=60.0):
+        self.max_retries = max_retries
+        self.headroom = headroom
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._rate = None
+        self._tokens = 1.0
+        self._updated = time.time()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token for one request and returns how many seconds the
+        caller must wait before sending it."""
+        with self._lock:
+            now = time.time()
+            delay = max(0.0, self._blocked_until - now)
+            if self._rate:
+                self._tokens = min(
+                    max(1.0, self._rate),
+                    self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    delay = max(delay, -self._tokens / self._rate)
+            return delay
+
+    def update(self, headers):
+        """Adjusts the request rate from the rate limit headers of a
+        response."""
+        now = time.time()
+        rates = []
+        blocked_until = 0.0
+        for prefix in self.RATE_LIMIT_HEADERS:
+            try:
+                limit = int(headers.get(prefix + "limit"))
+                remaining = int(headers.get(prefix + "remaining"))
+                reset = float(headers.get(prefix + "reset"))
+            except (TypeError, ValueError):
+                continue
+            if remaining <= limit * self.headroom:
+                # Out of budget: hold everything until the window resets,
+                # then resume at the long-run rate
+                blocked_until = max(blocked_until, reset)
+                rates.append(limit * (1 - self.headroom) / 60.0)
+            else:
+                rates.append((remaining - limit * self.headroom) /
+                             max(reset - now, 1.0))
+        if not rates:
+            return
+        with self._lock:
+            self._rate = max(min(rates), 0.1)
+            self._blocked_until = max(self._blocked_until, blocked_until)
+
+    def retry_delay(self, attempt, status, headers, idempotent):
+        """Returns the seconds to wait before retrying a request that got the
+        given status (None for a network error), or None to give up."""
+        if attempt >= self.max_retries:
+            return None
+        if status is None or status in self.RETRY_IDEMPOTENT:
+            if not idempotent:
+                return None
+        elif status not in self.RETRY_ALWAYS:
+            return None
+
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        try:
+            delay = max(delay, float(headers.get("retry-after")))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        if status == 429:
+            with self._lock:
+                self._blocked_until = max(
+                    self._blocked_until, time.time() + delay)
+        return delay
+
+
 class QuipClient(object):
     """A Quip API client"""
     # Edit operations
@@ -121,7 +308,7 @@ class QuipClient(object):
         BLUE = range(5)
 
     def __init__(self, access_token=None, client_id=None, client_secret=None,
-                 base_url=None, request_timeout=None):
+                 base_url=None, request_timeout=None, max_retries=None):
         """Constructs a Quip API client.
 
         If `access_token` is given, all of the API methods in the client
@@ -130,12 +317,22 @@ class QuipClient(object):
         Otherwise, only `get_authorization_url` and `get_access_token`
         work, and we assume the client is for a server using the Quip API's
         OAuth endpoint.
+
+        Requests are paced to Quip's rate limit headers, and rate limited or
+        unavailable responses are retried up to `max_retries` times.
         """
         self.access_token = access_token
         self.client_id = client_id
         self.client_secret = client_secret
         self.base_url = base_url if base_url else "https://platform.quip.com"
         self.request_timeout = request_timeout if request_timeout else 10
+        self._pool = _ConnectionPool(self.base_url, self.request_timeout)
+        self._scheduler = _RequestScheduler(
+            max_retries=5 if max_retries is None else max_retries)
+
+    def close(self):
+        """Closes the pooled keep-alive connections."""
+        self._pool.close()
 
     def get_authorization_url(self, redirect_uri, state=None):
         """Returns the URL the user should be redirected to to sign in."""
@@ -253,6 +450,11 @@ class QuipClient(object):
         """Returns a dictionary of threads for the given IDs."""
         return self._fetch_json("threads/", post_data={"ids": ",".join(ids)})
 
+    def get_thread_metadata(self, id):
+        """Returns the metadata (title, link, updated_usec, ...) of the thread
+        with the given ID, without downloading its HTML."""
+        return self._fetch_json("threads/" + id, api_version=2)
+
     def get_recent_threads(self, max_updated_usec=None, count=None, **kwargs):
         """Returns the recently updated threads for a given user."""
         return self._fetch_json(
@@ -734,7 +936,7 @@ class QuipClient(object):
         the given thread.
 
         The object is described in detail here:
-        https://docs.python.org/2/library/urllib2.html#urllib2.urlopen
+        https://docs.python.org/3/library/urllib.request.html#urllib.request.urlopen
         """
         request = Request(
             url=self._url("blob/%s/%s" % (thread_id, blob_id)))
@@ -783,36 +985,68 @@ class QuipClient(object):
         return self._fetch_json("websockets/new", **kwargs)
 
     def _fetch_json(self, path, post_data=None, **args):
-        request = Request(url=self._url(path, **args))
+        url = self._url(path, **args)
+        headers = {"Accept-Encoding": "identity"}
+        body = None
         if post_data:
             post_data = dict((k, v) for k, v in post_data.items()
                              if v or isinstance(v, int))
-            request_data = urlencode(self._clean(**post_data))
-            if PY3:
-                request.data = request_data.encode()
-            else:
-                request.data = request_data
+            body = urlencode(self._clean(**post_data)).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
 
         if self.access_token:
-            request.add_header("Authorization", "Bearer " + self.access_token)
-        try:
-            return json.loads(
-                urlopen(
-                    request, timeout=self.request_timeout).read().decode())
-        except HTTPError as error:
+            headers["Authorization"] = "Bearer " + self.access_token
+
+        split = urlsplit(url)
+        method = "POST" if body else "GET"
+        attempt = 0
+        while True:
+            delay = self._scheduler.reserve()
+            if delay > 0:
+                time.sleep(delay)
             try:
-                # Extract the developer-friendly error message from the response
-                message = json.loads(error.read().decode())["error_description"]
-            except Exception:
-                raise error
-            raise QuipError(error.code, message, error)
+                status, reason, response_headers, response_body = \
+                    self._pool.request(
+                        method,
+                        split.path + ("?" + split.query if split.query else ""),
+                        headers, body)
+            except httplib.InvalidURL:
+                raise
+            except (httplib.HTTPException, IOError):
+                delay = self._scheduler.retry_delay(
+                    attempt, None, None, method == "GET")
+                if delay is None:
+                    raise
+            else:
+                self._scheduler.update(response_headers)
+                if status < 400:
+                    break
+                delay = self._scheduler.retry_delay(
+                    attempt, status, response_headers, method == "GET")
+                if delay is None:
+                    break
+            logging.warning("Retrying %s in %.1fs", path, delay)
+            time.sleep(delay)
+            attempt += 1
+
+        if status < 400:
+            return json.loads(response_body.decode())
+
+        error = HTTPError(url, status, reason, response_headers,
+                          io.BytesIO(response_body))
+        try:
+            # Extract the developer-friendly error message from the response
+            message = json.loads(error.read().decode())["error_description"]
+        except Exception:
+            raise error
+        raise QuipError(error.code, message, error)
 
     def _clean(self, **args):
         return dict((k, str(v) if isinstance(v, int) else v.encode("utf-8"))
                     for k, v in args.items() if v or isinstance(v, int))
 
-    def _url(self, path, **args):
-        url = self.base_url + "/1/" + path
+    def _url(self, path, api_version=1, **args):
+        url = self.base_url + "/%d/" % api_version + path
         args = self._clean(**args)
         if args:
             url += "?" + urlencode(args)
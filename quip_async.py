@@ -0,0 +1,305 @@
+"""An asyncio variant of the Quip API client in quip.py.
+
+It lives in its own module so that the synchronous `QuipClient` does not pay
+for importing asyncio. Only the read-only endpoints are supported.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import ssl
+import urllib.parse
+
+from quip import HTTPError, QuipClient, QuipError, _RequestScheduler, \
+    _get_proxy, iteritems, urlencode
+
+
+class _AsyncConnectionPool(object):
+    """A pool of keep-alive HTTP/1.1 connections to a single host, built on
+    asyncio streams.
+
+    At most `max_connections` connections are open at once; callers beyond
+    that wait for a connection to be handed back. Like `QuipClient`,
+    connections go through the proxy set in the environment (`https_proxy`,
+    `http_proxy`, `no_proxy`), tunnelling HTTPS through it with CONNECT.
+    """
+
+    def __init__(self, base_url, max_connections, timeout):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.secure = url.scheme == "https"
+        self.port = url.port if url.port else (443 if self.secure else 80)
+        # The Host header keeps any port given in the URL
+        self.netloc = url.netloc.rpartition("@")[2]
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.proxy, self.proxy_headers = _get_proxy(url)
+        self.path_prefix = ""
+        self._idle = []
+        self._slots = None
+
+        if self.proxy is not None and not self.secure:
+            # A plain HTTP proxy is sent the whole URL
+            self.path_prefix = "http://" + self.netloc
+
+    async def request(self, method, path, headers, body=None):
+        """Sends a request and returns `(status, reason, headers, body)`."""
+        if self.path_prefix:
+            path = self.path_prefix + path
+            headers = dict(headers, **self.proxy_headers)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        async with self._slots:
+            # An idle connection may have been closed by the server since it
+            # was last used, in which case we retry once on a fresh one
+            reused = bool(self._idle)
+            try:
+                return await self._request(method, path, headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                return await self._request(method, path, headers, body)
+
+    async def close(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            writer.close()
+
+    async def _request(self, method, path, headers, body):
+        if self._idle:
+            reader, writer = self._idle.pop()
+        else:
+            reader, writer = await self._wait(self._connect())
+        try:
+            lines = ["%s %s HTTP/1.1" % (method, path), "Host: " + self.netloc,
+                     "Accept-Encoding: identity",
+                     "Content-Length: %d" % len(body or b"")]
+            lines.extend("%s: %s" % item for item in iteritems(headers))
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            if body:
+                writer.write(body)
+            status, reason, response_headers, response_body, keep_alive = \
+                await self._wait(self._read_response(reader))
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, reason, response_headers, response_body
+
+    async def _connect(self):
+        context = ssl.create_default_context() if self.secure else None
+        if self.proxy is None:
+            return await asyncio.open_connection(
+                self.host, self.port, ssl=context)
+        reader, writer = await asyncio.open_connection(*self.proxy)
+        if not self.secure:
+            return reader, writer
+
+        try:
+            target = "%s:%d" % (self.host, self.port)
+            lines = ["CONNECT %s HTTP/1.1" % target, "Host: " + target]
+            lines.extend("%s: %s" % item
+                         for item in iteritems(self.proxy_headers))
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            response = await reader.readuntil(b"\r\n\r\n")
+            status_line = response.split(b"\r\n", 1)[0].decode("latin-1")
+            if status_line.split(" ", 2)[1:2] != ["200"]:
+                raise ConnectionError("Tunnel connection failed: " + status_line)
+
+            if hasattr(writer, "start_tls"):
+                await writer.start_tls(context, server_hostname=self.host)
+            else:
+                # Before Python 3.11 the writer is rebuilt on the transport
+                # start_tls returns, which the stream reader now reads from,
+                # and the protocol told it is over TLS as 3.11 does
+                loop = asyncio.get_running_loop()
+                protocol = writer.transport.get_protocol()
+                transport = await loop.start_tls(
+                    writer.transport, protocol, context,
+                    server_hostname=self.host)
+                protocol._over_ssl = True
+                writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _wait(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Timed out talking to " + self.host)
+
+    async def _read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by " + self.host)
+        version, status, reason = (
+            status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get("connection", "").lower() != "close" and \
+            version != "HTTP/1.0"
+        status = int(status)
+        if status in (204, 304):
+            body = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return status, reason, headers, body, keep_alive
+
+
+class AsyncQuipClient(object):
+    """An asyncio Quip API client for the read-only endpoints.
+
+    All requests made through one client share a pool of keep-alive
+    connections, and at most `max_concurrency` requests are in flight at
+    once, so callers can safely `asyncio.gather` thousands of fetches:
+
+        async with quip_async.AsyncQuipClient(access_token=...) as client:
+            threads = await asyncio.gather(
+                *[client.get_thread(id) for id in thread_ids])
+    """
+
+    def __init__(self, access_token=None, base_url=None, request_timeout=None,
+                 max_concurrency=None, max_retries=None):
+        self.access_token = access_token
+        self.base_url = base_url if base_url else "https://platform.quip.com"
+        self.request_timeout = request_timeout if request_timeout else 10
+        self.max_concurrency = max_concurrency if max_concurrency else 50
+        self._pool = _AsyncConnectionPool(
+            self.base_url, self.max_concurrency, self.request_timeout)
+        self._scheduler = _RequestScheduler(
+            max_retries=5 if max_retries is None else max_retries)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Closes the pooled connections."""
+        await self._pool.close()
+
+    async def get_authenticated_user(self):
+        """Returns the user corresponding to our access token."""
+        return await self._fetch_json("users/current")
+
+    async def get_folders(self, ids):
+        """Returns a dictionary of folders for the given IDs."""
+        return await self._fetch_json(
+            "folders/", post_data={"ids": ",".join(ids)})
+
+    async def get_messages(self, thread_id, max_created_usec=None, count=None):
+        """Returns the most recent messages for the given thread.
+
+        See `QuipClient.get_messages`.
+        """
+        return await self._fetch_json(
+            "messages/" + thread_id, max_created_usec=max_created_usec,
+            count=count)
+
+    async def get_thread(self, id):
+        """Returns the thread with the given ID."""
+        return await self._fetch_json("threads/" + id)
+
+    async def get_threads(self, ids):
+        """Returns a dictionary of threads for the given IDs."""
+        return await self._fetch_json(
+            "threads/", post_data={"ids": ",".join(ids)})
+
+    async def get_matching_threads(
+            self, query, count=None, only_match_titles=False, **kwargs):
+        """Returns the recently updated threads for a given user."""
+        return await self._fetch_json(
+            "threads/search", query=query, count=count,
+            only_match_titles=only_match_titles, **kwargs)
+
+    async def get_blob(self, thread_id, blob_id):
+        """Returns the contents of the given blob from the given thread as
+        bytes."""
+        return await self._fetch("blob/%s/%s" % (thread_id, blob_id))
+
+    async def _fetch_json(self, path, post_data=None, **args):
+        return json.loads(
+            (await self._fetch(path, post_data, **args)).decode())
+
+    async def _fetch(self, path, post_data=None, **args):
+        url = self._url(path, **args)
+        headers = {}
+        body = None
+        if post_data:
+            post_data = dict((k, v) for k, v in post_data.items()
+                             if v or isinstance(v, int))
+            body = urlencode(self._clean(**post_data)).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.access_token:
+            headers["Authorization"] = "Bearer " + self.access_token
+
+        split = urllib.parse.urlsplit(url)
+        method = "POST" if body else "GET"
+        attempt = 0
+        while True:
+            delay = self._scheduler.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                status, reason, response_headers, response_body = \
+                    await self._pool.request(
+                        method,
+                        split.path + ("?" + split.query if split.query else ""),
+                        headers, body)
+            except (ConnectionError, TimeoutError, asyncio.IncompleteReadError):
+                delay = self._scheduler.retry_delay(
+                    attempt, None, None, method == "GET")
+                if delay is None:
+                    raise
+            else:
+                self._scheduler.update(response_headers)
+                if status < 400:
+                    break
+                delay = self._scheduler.retry_delay(
+                    attempt, status, response_headers, method == "GET")
+                if delay is None:
+                    break
+            logging.warning("Retrying %s in %.1fs", path, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        if status >= 400:
+            error = HTTPError(url, status, reason, response_headers,
+                              io.BytesIO(response_body))
+            try:
+                # Extract the developer-friendly error message from the response
+                message = json.loads(response_body.decode())["error_description"]
+            except Exception:
+                raise error
+            raise QuipError(status, message, error)
+        return response_body
+
+    _clean = QuipClient._clean
+    _url = QuipClient._url
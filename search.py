@@ -1,11 +1,26 @@
 import sys
-import quip
 import os
 import subprocess
 import http
+import html.entities
+import html.parser
 import urllib
+import urllib.parse
 import csv
-from bs4 import BeautifulSoup
+import json
+import re
+import hashlib
+import mmap
+import bisect
+import heapq
+import threading
+import time
+import unicodedata
+import zlib
+import queue
+import functools
+import contextlib
+import concurrent.futures
 
 
 #####################################################################
@@ -15,11 +30,85 @@ TEXT_INDENT = " - "
 CONFIG_FILENAME = ".search.py.settings"
 CONFIG_KEY_QUIP_ACCESS_TOKEN = "QUIP_ACCESS_TOKEN"
 CONFIG_KEY_QUIP_URL_STRIP = "QUIP_URL_STRIP"
+CONFIG_KEY_QUIP_BASE_URL = "QUIP_BASE_URL"
 CONFIG_KEY_SFDC_USERNAME = "SFDC_USERNAME"
 CONFIG_KEY_SFDC_QUERY = "SFDC_QUERY"
+CONFIG_KEY_SFDC_SOURCE = "SFDC_SOURCE"
+SFDC_SOURCE_SFDX = "sfdx"
+SFDC_SOURCE_REST = "rest"
+CONFIG_KEY_SFDC_INSTANCE_URL = "SFDC_INSTANCE_URL"
+CONFIG_KEY_SFDC_ACCESS_TOKEN = "SFDC_ACCESS_TOKEN"
+CONFIG_KEY_SFDC_API_VERSION = "SFDC_API_VERSION"
+DEFAULT_SFDC_API_VERSION = "v59.0"
+SFDC_REQUEST_TIMEOUT = 60
 CONFIG_KEY_KEYWORDS = "KEYWORDS"
 CONFIG_KEY_MAX_RESULTS = "MAX_RESULTS"
 CONFIG_KEY_CACHE_DIR = "CACHE_DIR"
+CONFIG_KEY_CACHE_BACKEND = "CACHE_BACKEND"
+CACHE_BACKEND_FILES = "files"
+CACHE_BACKEND_BLOBS = "blobs"
+CONFIG_KEY_TEXT_EXTRACTOR = "TEXT_EXTRACTOR"
+TEXT_EXTRACTOR_STREAM = "stream"
+TEXT_EXTRACTOR_LXML = "lxml"
+TEXT_EXTRACTOR_SOUP = "soup"
+CONFIG_KEY_QUIP_BULK_SIZE = "QUIP_BULK_SIZE"
+DEFAULT_QUIP_BULK_SIZE = 50
+CONFIG_KEY_WORKERS = "WORKERS"
+DEFAULT_WORKERS = 1
+OPTION_WORKERS = "--workers"
+OPTION_REFRESH = "--refresh"
+OPTION_REFRESH_SOQL = "--refresh-soql"
+OPTION_PROFILE = "--profile"
+OPTION_RESUME = "--resume"
+JOURNAL_FILENAME = "journal.jsonl"
+METRICS_FILENAME = "metrics.json"
+PROFILE_FILENAME = "search.prof"
+CONFIG_KEY_SOQL_CACHE_TTL = "SOQL_CACHE_TTL"
+DEFAULT_SOQL_CACHE_TTL = 3600
+CONFIG_KEY_PROCESSES = "PROCESSES"
+DEFAULT_PROCESSES = 0
+OPTION_PROCESSES = "--processes"
+PROCESS_CHUNK_SIZE = 8
+REPORT_QUEUE_BATCHES = 2
+AUTOMATON_MIN_TERMS = 200
+DOC_TYPE_AP = "ap"
+DOC_TYPE_CS = "cs"
+DOC_TYPE_LABELS = { DOC_TYPE_AP: "Account Plan", DOC_TYPE_CS: "CS Plan" }
+FETCH_ERROR_INVALID_URL = "invalid_url"
+FETCH_ERROR_ACCESS = "access"
+FETCH_ERROR_SERVER = "server"
+FETCH_ERROR_TIMEOUT = "timeout"
+CONFIG_KEY_FAILURE_TTL_PREFIX = "FAILURE_TTL_"
+DEFAULT_FAILURE_TTLS = { FETCH_ERROR_INVALID_URL: 30 * 24 * 3600, FETCH_ERROR_ACCESS: 3 * 24 * 3600, FETCH_ERROR_SERVER: 0, FETCH_ERROR_TIMEOUT: 0 }
+FAILURES_FILENAME = "failures.csv"
+CONFIG_KEY_SEARCH_INDEX = "SEARCH_INDEX"
+SEARCH_INDEX_NONE = "none"
+SEARCH_INDEX_FTS = "fts"
+SEARCH_INDEX_TRIGRAM = "trigram"
+SEARCH_INDEX_CORPUS = "corpus"
+CORPUS_MANIFEST_FILENAME = "corpus.json"
+OPTION_SHARD = "--shard"
+OPTION_MERGE = "--merge"
+REPORT_FILENAME = "report.csv"
+CONFIG_KEY_REPORT_FORMAT = "REPORT_FORMAT"
+REPORT_FORMAT_CSV = "csv"
+REPORT_FORMAT_PARQUET = "parquet"
+REPORT_FORMAT_ARROW = "arrow"
+OPTION_FORMAT = "--format"
+REPORT_ACCOUNT_COLUMNS = 5
+COLUMNAR_BATCH_SIZE = 10000
+SHARD_ROW_COLUMN = "Row"
+MERGE_BATCH_SIZE = 1000
+OPTION_INDEX = "--index"
+INDEX_FILENAME = "index.sqlite"
+INDEX_CHUNK_SIZE = 25
+
+
+#####################################################################
+## Raised when a search can't run, carrying the message to show
+#####################################################################
+class SearchError(Exception):
+    pass
 
 
 #####################################################################
@@ -29,23 +118,30 @@ def main():
     print("search.py")
     print()
 
-    print ("Usage: search.py [<search_term> .......]")
+    print ("Usage: search.py [--workers <n>] [--processes <n>] [--refresh] [--refresh-soql] [--resume] [--index fts|trigram|corpus] [--shard <i>/<n>] [--merge <n>] [--format csv|parquet|arrow] [--profile] [<search_term> .......]")
     print ("<search_term> can be repeated to incorporate searching on as many terms as desired")
+    print ("--workers <n> downloads and processes up to n accounts concurrently")
+    print ("--processes <n> parses and searches downloaded documents on n processes")
+    print ("--refresh re-downloads cached documents that have changed in Quip since they were cached")
+    print ("--refresh-soql runs the SOQL query again even if its cached result has not expired yet")
+    print ("--resume reuses the accounts the last run finished, as recorded in its journal, and only searches the rest")
+    print ("--index " + SEARCH_INDEX_FTS + " counts whole words with an SQLite full-text index of the cached documents, kept in " + INDEX_FILENAME + ", instead of scanning them")
+    print ("--index " + SEARCH_INDEX_TRIGRAM + " gives the same counts as scanning, reading only the cached documents a trigram index of " + INDEX_FILENAME + " finds each term in")
+    print ("--index " + SEARCH_INDEX_CORPUS + " gives the same counts as scanning, matching over one memory-mapped file of every cached document's text")
+    print ("--shard <i>/<n> searches only the i-th of n shards of the accounts, in the shard's own directory of the cache directory")
+    print ("--merge <n> combines the reports of n shards into " + REPORT_FILENAME + " in the order of the SOQL query")
+    print ("--format parquet|arrow writes the report as report.parquet or report.arrow with numeric counts instead of " + REPORT_FILENAME + "; shard reports are always CSV, so pass it to --merge instead")
+    print ("--profile writes a cProfile dump of the run's threads to " + PROFILE_FILENAME + " in the cache directory")
     print ()
 
     config = load_config()
 
     # pull from command-line first
-    searchTerms = sys.argv
-    del searchTerms[0]
+    options, searchTerms = parse_options(sys.argv[1:])
 
     # append from config file
     searchTerms = searchTerms + config[CONFIG_KEY_KEYWORDS].strip().split(",")
 
-    if (len(searchTerms) == 0):
-        print ("At least one search term is required, either via command line or in the properties file!")
-        sys.exit()
-
     print ("Search Terms:")
     for searchTerm in searchTerms:
         print(TEXT_INDENT + searchTerm)
@@ -56,210 +152,2139 @@ def main():
         print ("Cache Directory is empty but required!")
         sys.exit()
 
-    quipAccessToken = config[CONFIG_KEY_QUIP_ACCESS_TOKEN].strip()
+    profiler = None
+    if (OPTION_PROFILE in options):
+        profiler = RunProfiler()
+        profiler.start()
+
+    reportFormat = options.get(OPTION_FORMAT, config.get(CONFIG_KEY_REPORT_FORMAT, REPORT_FORMAT_CSV)).strip()
+    report = None
+    try:
+        shard = parse_shard(options.get(OPTION_SHARD))
+        if (OPTION_MERGE in options):
+            report = open_report(reportFormat, cacheDir)
+            merge_shard_reports(cacheDir, options[OPTION_MERGE], report)
+        else:
+            # shard reports are merged from CSV whatever the final format
+            if (shard != None):
+                report = CsvReport(get_run_dir(cacheDir, shard) + "/" + REPORT_FILENAME)
+            else:
+                report = open_report(reportFormat, cacheDir)
+            search(config, searchTerms, options=options, report=report)
+    except SearchError as e:
+        print (str(e))
+        sys.exit()
+    finally:
+        if (report != None):
+            report.close()
+        if (profiler != None):
+            profileFilename = cacheDir + "/" + PROFILE_FILENAME
+            profiler.stop(profileFilename)
+            print ("Profile written to " + profileFilename)
+
+    print ("Number of lines: " + str(report.lines))
+    print (reportFormat.upper() + " Output Complete!")
 
-    sfdcCsvText = sfdc_query(cacheDir, config)
-    results = sfdcCsvText.splitlines()
-    header = results[0]
-    del results[0]
 
-    outputHeader = header.split(",")
-    outputHeader = outputHeader + searchTerms
-    output = [ outputHeader ]
+#####################################################################
+## Searches the Quip documents of every account the SOQL query
+## returns for the search terms.  This is the entry point for using
+## search.py as a library:
+##
+##     import search
+##     rows = search.search(config, [ "kubernetes", "ansible" ])
+##
+## config holds the same keys as the settings file, and options the
+## same keys as the command line, e.g. { search.OPTION_WORKERS: 4 }.
+## The cache is opened from the config unless one is passed in, in
+## which case the caller closes it.  Returns the report rows, header
+## first, or None when they are written to the given report instead,
+## which keeps memory flat however many accounts there are.  The run
+## journal, failures.csv and metrics.json are written to CACHE_DIR as
+## for the command line.  Raises SearchError when the search can't run.
+#####################################################################
+def search(config, searchTerms, cache=None, options=None, report=None):
+    if (options == None):
+        options = dict()
+    if (len(searchTerms) == 0):
+        raise SearchError("At least one search term is required, either via command line or in the properties file!")
 
-    maxResults = int(config[CONFIG_KEY_MAX_RESULTS].strip())
+    cacheDir = config.get(CONFIG_KEY_CACHE_DIR, "")
+    if (len(cacheDir) == 0):
+        raise SearchError("Cache Directory is empty but required!")
+    shard = parse_shard(options.get(OPTION_SHARD))
+    runDir = get_run_dir(cacheDir, shard)
+
+    workers = int(options.get(OPTION_WORKERS, config.get(CONFIG_KEY_WORKERS, DEFAULT_WORKERS)))
+    if (workers < 1):
+        raise SearchError("Number of workers must be at least 1!  Workers=" + str(workers))
+    processes = int(options.get(OPTION_PROCESSES, config.get(CONFIG_KEY_PROCESSES, DEFAULT_PROCESSES)))
+
+    rows = None
+    if (report == None):
+        report = ListReport()
+        rows = report.rows
+
+    ownCache = (cache == None)
+    if (ownCache):
+        cache = open_cache(config, runDir)
+
+    metrics.reset()
+    runStart = time.perf_counter()
+    try:
+        run_search(config, searchTerms, cache, options, report, cacheDir, runDir, shard, workers, processes)
+    finally:
+        if (ownCache):
+            cache.close()
 
-    numResults = 0
-    for line in csv.reader(results, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL, skipinitialspace=True):
+        metrics.record("run", time.perf_counter() - runStart)
+        metricsFilename = runDir + "/" + METRICS_FILENAME
+        metrics.write(metricsFilename)
+        print ("Run metrics written to " + metricsFilename)
+
+    return rows
+
+
+#####################################################################
+## Runs the search pipeline: SOQL rows are read as the source produces
+## them and handed through fetching, searching and report writing a
+## batch at a time, so only a few batches are ever in memory.  The
+## SOQL result is cached in cacheDir and everything else in runDir,
+## which is a shard's own directory when searching one shard.
+#####################################################################
+def run_search(config, searchTerms, cache, options, report, cacheDir, runDir, shard, workers, processes):
+    matcher = TermMatcher(searchTerms)
+    textExtractor = get_text_extractor(config)
+
+    # one client for the whole run, so its connections are reused and
+    # authentication is only checked once
+    client = get_quip_client(config[CONFIG_KEY_QUIP_ACCESS_TOKEN].strip(), config.get(CONFIG_KEY_QUIP_BASE_URL))
+
+    rows = sfdc_query(cacheDir, config, OPTION_REFRESH_SOQL in options)
+    with metrics.timer("soql"):
+        header = next(rows, None)
+    if (header == None):
+        raise SearchError("SOQL query did not return any accounts!")
+
+    outputHeader = header + searchTerms
+
+    maxResults = int(config.get(CONFIG_KEY_MAX_RESULTS, "0").strip())
+    quipUrlStrip = config[CONFIG_KEY_QUIP_URL_STRIP].strip()
+    bulkSize = int(config.get(CONFIG_KEY_QUIP_BULK_SIZE, DEFAULT_QUIP_BULK_SIZE))
+    failureTtls = get_failure_ttls(config)
+
+    # documents come up again in later batches once their searches are
+    # released, and with --refresh each is checked just once per run
+    checkedDocIds = set()
+
+    def search_docs_in_thread(docIds, fetchErrors):
+        return search_docs(cache, client, docIds, matcher, textExtractor, fetchErrors), None
+
+    def search_docs_in_index(docIds, fetchErrors):
+        return search_docs_indexed(cache, index, docIds, textExtractor, fetchErrors), None
+
+    indexKind = options.get(OPTION_INDEX, config.get(CONFIG_KEY_SEARCH_INDEX, SEARCH_INDEX_NONE)).strip()
+    index = open_search_index(indexKind, runDir, searchTerms)
+    if (index != None):
+        # answering from the index is mostly queries, so threads are
+        # enough to extract the documents that aren't indexed yet
+        print ("Searching documents with the " + indexKind + " index...")
+        searchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        searchFn = search_docs_in_index
+        chunkSize = INDEX_CHUNK_SIZE
+    elif (processes > 0):
+        import multiprocessing
+
+        # parsing and matching is CPU bound, so spread it over processes;
+        # each one reads its documents from the cache itself
+        print ("Searching documents on " + str(processes) + " processes...")
+        # processes are spawned rather than forked, since the fetch
+        # threads may be holding locks at the moment a process starts
+        searchExecutor = concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_search_process,
+            initargs=(config, runDir, searchTerms), mp_context=multiprocessing.get_context("spawn"))
+        searchFn = search_docs_in_process
+        chunkSize = PROCESS_CHUNK_SIZE
+    else:
+        searchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        searchFn = search_docs_in_thread
+        chunkSize = 1
+
+    # accounts often share documents, so a doc ID is fetched and
+    # searched once for every account queued while its search is held,
+    # and each account row adds up the counts of its documents: doc ID
+    # -> [future, index in the future's result, rows still to read it].
+    # The last row to read a search releases it, so only the searches
+    # of queued rows are ever held, however many documents there are
+    docSearches = dict()
+    docSearchesLock = threading.Lock()
+
+    def get_doc_ids(line):
+        docIds = []
+        for docType, url in ((DOC_TYPE_AP, line[3].strip()), (DOC_TYPE_CS, line[4].strip())):
+            if (len(url) > 0):
+                docIds.append((docType, url, get_quip_doc_id(quipUrlStrip, url)))
+        return docIds
+
+    def get_rows(line):
         accountId = line[0].strip()
         accountName = line[1].strip()
-        accountSubRegion = line[2].strip()
-        accountPlanUrl = line[3].strip()
-        csPlanUrl = line[4].strip()
+        counts = [ 0 ] * len(searchTerms)
+        for docType, url, docId in get_doc_ids(line):
+            with docSearchesLock:
+                docSearch = docSearches[docId]
+            future, i, rowCount = docSearch
+            docCounts, error = future.result()[0][i]
+            with docSearchesLock:
+                docSearch[2] = docSearch[2] - 1
+                if (docSearch[2] == 0):
+                    del docSearches[docId]
+            if (error != None):
+                print_fetch_error(error, docType, accountId, accountName, url)
+                failures.write(accountId, accountName, docType, url, docId, error)
+            elif (docCounts != None):
+                counts = [x + y for x, y in zip(counts, docCounts)]
+        return [ get_account_row(line, counts) ]
+
+    # every finished account is journaled, so a resumed run can replay
+    # it rather than fetch and search its documents again
+    journal = RunJournal(runDir + "/" + JOURNAL_FILENAME, outputHeader, OPTION_RESUME in options)
+
+    # the writer takes results in submission order, keeping the report
+    # in SOQL order; a shard's rows also carry their SOQL row number,
+    # so the shards' reports can be merged back into that order
+    writer = ReportWriter(report, outputHeader, REPORT_QUEUE_BATCHES * bulkSize, journal, shard != None)
+    failures = FailureReport(runDir + "/" + FAILURES_FILENAME)
+    try:
+        with searchExecutor, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as fetchExecutor:
+            # pull each batch's uncached documents in as few requests as
+            # possible, then search it while the next batch is fetched
+            def search_batch(batch):
+                # held searches are claimed for the batch's rows right
+                # away, so none is released before those rows read it
+                docIds = []
+                rowCounts = dict()
+                if (index != None):
+                    index.tag_accounts([(line[0].strip(), get_doc_ids(line)) for rowIndex, line in batch])
+                with docSearchesLock:
+                    for rowIndex, line in batch:
+                        if (journal.get(line) != None):
+                            continue
+                        for docType, url, docId in get_doc_ids(line):
+                            if (docId in docSearches):
+                                docSearches[docId][2] = docSearches[docId][2] + 1
+                            else:
+                                if (docId not in rowCounts):
+                                    docIds.append(docId)
+                                rowCounts[docId] = rowCounts.get(docId, 0) + 1
+
+                with metrics.timer("fetch"):
+                    fetchErrors = prefetch_quip_docs(fetchExecutor, cache, client, docIds, bulkSize, OPTION_REFRESH in options, checkedDocIds, failureTtls)
+                for i in range(0, len(docIds), chunkSize):
+                    chunk = docIds[i:i + chunkSize]
+                    future = searchExecutor.submit(searchFn, chunk, dict((d, fetchErrors[d]) for d in chunk if d in fetchErrors))
+                    future.add_done_callback(merge_search_metrics)
+                    with docSearchesLock:
+                        for j in range(len(chunk)):
+                            docSearches[chunk[j]] = [future, j, rowCounts[chunk[j]]]
+
+                for rowIndex, line in batch:
+                    row = journal.get(line)
+                    if (row != None):
+                        metrics.add("accounts_resumed")
+                        writer.put(functools.partial(list, [ row ]), rowIndex)
+                    else:
+                        writer.put(functools.partial(get_rows, line), rowIndex)
+
+            accounts = 0
+            batch = []
+            for line in metrics.timed_iter("soql", rows):
+                # every shard reads the whole SOQL result and keeps the
+                # accounts that hash to it, so the limit below and the
+                # row numbers are the same in every shard
+                if (shard == None) or (get_account_shard(line[0].strip(), shard[1]) == shard[0]):
+                    batch.append((accounts, line))
+                    metrics.add("accounts")
+                accounts = accounts + 1
+
+                if (len(batch) >= bulkSize):
+                    search_batch(batch)
+                    batch = []
+
+                if (maxResults != 0) and (accounts >= maxResults):
+                    print ("Max Results Limit reached: " + str(maxResults))
+                    break
+
+            if (len(batch) > 0):
+                search_batch(batch)
+    finally:
+        rows.close()
+        writer.close()
+        failures.close()
+        journal.close()
+        if (index != None):
+            index.close()
+        metrics.add("report_lines", writer.lines)
 
-        o = process_account(cacheDir, quipAccessToken, config[CONFIG_KEY_QUIP_URL_STRIP].strip(), accountId, accountName, accountSubRegion, accountPlanUrl, csPlanUrl, searchTerms)
-        output.append(o)
 
-        numResults += 1
-        if (maxResults != 0) and (numResults >= maxResults):
-            print ("Max Results Limit reached: " + str(maxResults))
-            break
+#####################################################################
+## Returns the directory a run keeps its cache, journal and reports
+## in: the cache directory, or a shard's own directory under it
+#####################################################################
+def get_run_dir(cacheDir, shard):
+    if (shard == None):
+        return cacheDir
 
-    print ("Number of lines: " + str(len(output)))
-    outputFilename = cacheDir + "/report.csv"
-    delete_file(outputFilename)
-    with open(outputFilename, "x") as csvFile:
-        csvWriter = csv.writer(csvFile, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL)
-        for line in output:
-            line = [x.strip() for x in line]
-            csvWriter.writerow(line)
+    runDir = cacheDir + "/" + get_shard_name(shard)
+    os.makedirs(runDir, exist_ok=True)
+    return runDir
 
-    print ("CSV Output Complete!")
+
+#####################################################################
+## Names a shard's directory, e.g. shard-2-of-4
+#####################################################################
+def get_shard_name(shard):
+    return "shard-" + str(shard[0]) + "-of-" + str(shard[1])
 
 
 #####################################################################
-# Deletes the file from disk, if it exists
+## Returns the shard, from 1 to shardCount, an account belongs to.
+## Hashing the account ID puts it in the same shard on every machine
+## and in every run, whatever order the SOQL query returns it in.
 #####################################################################
-def delete_file(filename):
+def get_account_shard(accountId, shardCount):
+    return int(hashlib.sha1(accountId.encode("utf-8")).hexdigest(), 16) % shardCount + 1
+
+
+#####################################################################
+## Merges the reports of every shard, found in their directories
+## under the cache directory, into one report in SOQL order.  Shards
+## run elsewhere have their report.csv copied into place first.
+#####################################################################
+def merge_shard_reports(cacheDir, shardCount, report):
     try:
-        os.remove(filename)
-    except FileNotFoundError:
+        shardCount = int(shardCount)
+    except ValueError:
+        raise SearchError("Number of shards to merge must be a number!  Received: " + shardCount)
+    if (shardCount < 1):
+        raise SearchError("Number of shards to merge must be at least 1!  Shards=" + str(shardCount))
+
+    files = []
+    try:
+        readers = []
+        header = None
+        for i in range(1, shardCount + 1):
+            filename = cacheDir + "/" + get_shard_name((i, shardCount)) + "/" + REPORT_FILENAME
+            try:
+                files.append(open(filename, "r", newline=""))
+            except FileNotFoundError:
+                raise SearchError("Report of shard " + str(i) + " of " + str(shardCount) + " not found: " + filename)
+
+            reader = csv.reader(files[-1])
+            shardHeader = next(reader, None)
+            if (shardHeader == None) or (shardHeader[0] != SHARD_ROW_COLUMN):
+                raise SearchError("Not a shard report: " + filename)
+            if (header != None) and (shardHeader != header):
+                raise SearchError("Shard reports are for different queries or search terms: " + filename)
+            header = shardHeader
+            readers.append(reader)
+
+        # each shard's rows are already in SOQL order
+        report.write([header[1:]])
+        lines = []
+        for row in heapq.merge(*readers, key=lambda row: int(row[0])):
+            lines.append(row[1:])
+            if (len(lines) >= MERGE_BATCH_SIZE):
+                report.write(lines)
+                lines = []
+        report.write(lines)
+    finally:
+        for f in files:
+            f.close()
+
+    print ("Merged the reports of " + str(shardCount) + " shards")
+
+
+#####################################################################
+# Adds the metrics a search process collected for a chunk of
+# documents to the run's metrics
+#####################################################################
+def merge_search_metrics(future):
+    if (future.cancelled()) or (future.exception() != None):
         return
+    snapshot = future.result()[1]
+    if (snapshot != None):
+        metrics.merge(snapshot)
+
 
 #####################################################################
-# Cache the specified AP document
+# Run metrics: counters, error counts by exception type and timings
+# per stage.  Stage timings are summed across threads, so they can
+# add up to more than the run's wall time.  One instance is shared by
+# the whole run; search processes keep their own and send a snapshot
+# back with each chunk they finish.
 #####################################################################
-def cache_ap(cacheDir, accountId, apText):
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.errors = dict()
+            self.timings = dict()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def error(self, e):
+        name = type(e).__name__
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    # times how long each item takes to arrive from the iterator
+    def timed_iter(self, stage, iterator):
+        iterator = iter(iterator)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def snapshot(self):
+        with self.lock:
+            return { "counters": dict(self.counters), "errors": dict(self.errors), "timings": dict((k, list(v)) for k, v in self.timings.items()) }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, value in snapshot["errors"].items():
+                self.errors[name] = self.errors.get(name, 0) + value
+            for stage, seconds in snapshot["timings"].items():
+                self.timings.setdefault(stage, []).extend(seconds)
+
+    def summary(self):
+        with self.lock:
+            stages = dict()
+            for stage, seconds in self.timings.items():
+                ordered = sorted(seconds)
+                stages[stage] = {
+                    "count": len(ordered),
+                    "seconds": sum(ordered),
+                    "p50": ordered[(len(ordered) - 1) // 2],
+                    "p99": ordered[min(len(ordered) - 1, (len(ordered) * 99) // 100)],
+                    "max": ordered[-1]
+                }
+            return { "counters": dict(self.counters), "errors": dict(self.errors), "stages": stages }
+
+    def write(self, filename):
+        tempFilename = filename + ".tmp"
+        with open(tempFilename, "w") as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+        os.replace(tempFilename, filename)
+
+metrics = Metrics()
+
 
-    filename = cacheDir + "/" + accountId + "_ap.html"
-    with open(filename, 'x') as f:
-        f.write(apText)
+#####################################################################
+# Profiles the run with cProfile.  cProfile only follows the thread
+# that enabled it, so every thread started while profiling gets its
+# own profiler and they are combined into one dump at the end.
+# Search processes are not profiled.
+#####################################################################
+class RunProfiler:
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.start_thread()
+        # from Python 3.12 one profiler sees every thread; before that
+        # each thread starts its own as it makes its first call
+        if (sys.version_info < (3, 12)):
+            threading.setprofile(self.start_thread)
+
+    def start_thread(self, *args):
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler already sees this thread, so stop being
+            # called for each of its calls
+            sys.setprofile(None)
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def stop(self, filename):
+        threading.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.disable()
+        import pstats
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(filename)
 
 
 #####################################################################
-# Cache the specified cs document
+# Writes report rows to disk as their searches finish.  Functions
+# returning rows are queued in report order and a background thread
+# calls each in turn, waiting on whatever searches it needs, so rows
+# land in SOQL order and a run that dies partway still leaves the rows
+# finished so far.  The queue is bounded, holding back the producer
+# when the searches fall behind.
 #####################################################################
-def cache_cs(cacheDir, accountId, csText):
+class ReportWriter:
+    def __init__(self, report, header, queueSize, journal, numbered=False):
+        self.report = report
+        self.journal = journal
+        self.numbered = numbered
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.lines = 0
+        self.error = None
+
+        if (numbered):
+            self.write([[ SHARD_ROW_COLUMN ] + header])
+        else:
+            self.write([header])
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Queues a function that returns a list of report rows, and the
+    # SOQL row number they are written with when rows are numbered
+    def put(self, getRows, rowIndex=None):
+        if (self.error != None):
+            raise self.error
+        self.queue.put((getRows, rowIndex))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if (item == None):
+                break
+            # after a failure keep draining, so the producer never blocks
+            if (self.error != None):
+                continue
+            try:
+                getRows, rowIndex = item
+                rows = getRows()
+                if (self.numbered):
+                    self.write([[ str(rowIndex) ] + row for row in rows])
+                else:
+                    self.write(rows)
+                self.journal.record(rows)
+            except BaseException as e:
+                self.error = e
+
+    def write(self, lines):
+        with metrics.timer("report_write"):
+            self.report.write([[x.strip() if isinstance(x, str) else x for x in line] for line in lines])
+        self.lines = self.lines + len(lines)
+
+    # Waits for every queued row to be written
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if (self.error != None):
+            raise self.error
 
-    filename = cacheDir + "/" + accountId + "_cs.html"
-    with open(filename, 'x') as f:
-        f.write(csText)
+
+#####################################################################
+# Opens the report.csv, report.parquet or report.arrow report in the
+# given directory
+#####################################################################
+def open_report(reportFormat, directory):
+    if (reportFormat == REPORT_FORMAT_CSV):
+        return CsvReport(directory + "/" + REPORT_FILENAME)
+    elif (reportFormat == REPORT_FORMAT_PARQUET) or (reportFormat == REPORT_FORMAT_ARROW):
+        return ColumnarReport(directory + "/report." + reportFormat, reportFormat)
+
+    raise SearchError("Unknown report format!  Expected " + REPORT_FORMAT_CSV + ", " + REPORT_FORMAT_PARQUET + " or " +
+        REPORT_FORMAT_ARROW + " and received: " + reportFormat)
 
 
 #####################################################################
-# Gets the cached AP if it exists
+# Report written to a CSV file, flushed after every write so the file
+# always holds every row finished so far
 #####################################################################
-def get_cached_ap(cacheDir, accountId):
-    filename = cacheDir + "/" + accountId + "_ap.html"
+class CsvReport:
+    def __init__(self, filename):
+        self.lines = 0
+        delete_file(filename)
+        self.csvFile = open(filename, "x")
+        self.csvWriter = csv.writer(self.csvFile, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL)
 
-    try:
-        with open(filename, 'r') as f:
-            return f.read()
-    except FileNotFoundError:
-        return ""
+    def write(self, lines):
+        for line in lines:
+            self.csvWriter.writerow(line)
+        self.lines = self.lines + len(lines)
+        self.csvFile.flush()
+
+    def close(self):
+        self.csvFile.close()
+
+
+#####################################################################
+# Report written with pyarrow to a Parquet file or an Arrow IPC file,
+# which analytics tools load without parsing: the account columns
+# are dictionary encoded strings and each search term's count is an
+# int64 column.  Rows are written COLUMNAR_BATCH_SIZE at a time, so
+# unlike a CSV report the file is only complete once it is closed.
+#####################################################################
+class ColumnarReport:
+    def __init__(self, filename, reportFormat):
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise SearchError("The " + reportFormat + " report format requires pyarrow!  pip3 install pyarrow")
+
+        self.pyarrow = pyarrow
+        self.filename = filename
+        self.reportFormat = reportFormat
+        self.lines = 0
+        self.schema = None
+        self.writer = None
+        self.rows = []
+        delete_file(filename)
+
+    def write(self, lines):
+        for line in lines:
+            if (self.schema == None):
+                self.open(line)
+            else:
+                self.rows.append(line)
+        self.lines = self.lines + len(lines)
+
+        if (len(self.rows) >= COLUMNAR_BATCH_SIZE):
+            self.flush()
+
+    # the first line is the header, which sets the columns
+    def open(self, header):
+        pa = self.pyarrow
+        accountType = pa.dictionary(pa.int32(), pa.string())
+        self.schema = pa.schema([pa.field(name, accountType) for name in header[:REPORT_ACCOUNT_COLUMNS]] +
+            [pa.field(name, pa.int64()) for name in header[REPORT_ACCOUNT_COLUMNS:]])
+
+        # value -> index, per account column
+        self.dictionaries = [dict() for name in header[:REPORT_ACCOUNT_COLUMNS]]
+        if (self.reportFormat == REPORT_FORMAT_PARQUET):
+            self.writer = pa.parquet.ParquetWriter(self.filename, self.schema)
+        else:
+            # an Arrow file can't replace a dictionary, so each batch
+            # only adds the values new to it
+            self.writer = pa.ipc.new_file(self.filename, self.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def flush(self):
+        if (len(self.rows) == 0):
+            return
+
+        pa = self.pyarrow
+        # each Parquet row group keeps its own dictionaries
+        if (self.reportFormat == REPORT_FORMAT_PARQUET):
+            self.dictionaries = [dict() for d in self.dictionaries]
+
+        columns = []
+        for i, values in enumerate(self.dictionaries):
+            indices = [values.setdefault(row[i], len(values)) for row in self.rows]
+            columns.append(pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(list(values), pa.string())))
+        for i in range(len(self.dictionaries), len(self.schema)):
+            columns.append(pa.array([int(row[i]) for row in self.rows], pa.int64()))
+
+        self.writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        if (self.writer != None):
+            self.flush()
+            self.writer.close()
 
 
 #####################################################################
-# Gets the cached CS if it exists
+# Report kept in memory, for callers of search() that want the rows
 #####################################################################
-def get_cached_cs(cacheDir, accountId):
-    filename = cacheDir + "/" + accountId + "_cs.html"
+class ListReport:
+    def __init__(self):
+        self.rows = []
 
+    def write(self, lines):
+        self.rows.extend(lines)
+
+    def close(self):
+        return
+
+
+#####################################################################
+# Journal of the accounts a run has finished, one JSON report row per
+# line after a first line holding the report header.  A resumed run
+# loads the rows of a journal with the same header, dropping a last
+# line cut short by a crash, and keeps appending to it; otherwise the
+# journal starts over.  Accounts are recognised by their ID and plan
+# URLs.
+#####################################################################
+class RunJournal:
+    def __init__(self, filename, header, resume):
+        self.rows = dict()
+        self.lock = threading.Lock()
+
+        if (resume):
+            self.load(filename, header)
+            print ("Resuming run, " + str(len(self.rows)) + " accounts already finished")
+
+        if (len(self.rows) == 0):
+            self.file = open(filename, "w")
+            self.file.write(json.dumps({ "header": header }) + "\n")
+            self.file.flush()
+        else:
+            self.file = open(filename, "a")
+
+    def load(self, filename, header):
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        lines = data.split(b"\n")
+        try:
+            if (json.loads(lines[0]).get("header") != header):
+                print ("Journal is for a different query or search terms, starting over")
+                return
+        except ValueError:
+            return
+
+        # the last line is only complete if the file ends in a newline
+        end = len(lines[0]) + 1
+        for line in lines[1:-1]:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                break
+            self.rows[self.key(row)] = row
+            end = end + len(line) + 1
+
+        # cut off anything after the last complete row before appending
+        with open(filename, "r+b") as f:
+            f.truncate(end)
+
+    def key(self, line):
+        return "\n".join([x.strip() for x in line[:5]])
+
+    # returns the journaled report row for a SOQL line, or None
+    def get(self, line):
+        return self.rows.get(self.key(line))
+
+    def record(self, rows):
+        with self.lock:
+            for row in rows:
+                if (self.key(row) not in self.rows):
+                    self.file.write(json.dumps(row) + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+#####################################################################
+# Lists every account document that could not be pulled this run,
+# with why, and whether it was skipped as a known failure rather
+# than requested again
+#####################################################################
+class FailureReport:
+    def __init__(self, filename):
+        self.lines = 0
+        delete_file(filename)
+        self.csvFile = open(filename, "x")
+        self.csvWriter = csv.writer(self.csvFile, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL)
+        self.csvWriter.writerow([ "AccountID", "AccountName", "Document", "URL", "DocID", "Category", "Reason", "FailedAt", "Skipped" ])
+
+    def write(self, accountId, accountName, docType, url, docId, error):
+        failedAt = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(error["failed"]))
+        self.csvWriter.writerow([ accountId, accountName, DOC_TYPE_LABELS[docType], url, docId, error["category"], error["reason"], failedAt, str(error["skipped"]).lower() ])
+        self.csvFile.flush()
+        self.lines = self.lines + 1
+
+    def close(self):
+        self.csvFile.close()
+
+
+#####################################################################
+# Writes a file by way of a temporary file that replaces it in one
+# step, so a run killed partway never leaves a truncated file behind
+#####################################################################
+def write_file_atomic(filename, text):
+    tempFilename = filename + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+    with open(tempFilename, "w") as f:
+        f.write(text)
+    os.replace(tempFilename, filename)
+
+
+#####################################################################
+# Deletes the file from disk, if it exists
+#####################################################################
+def delete_file(filename):
     try:
-        with open(filename, 'r') as f:
-            return f.read()
+        os.remove(filename)
     except FileNotFoundError:
-        return ""
+        return
+
+#####################################################################
+# Extracts the casefolded plain text that search terms are matched
+# against from a document's HTML
+#####################################################################
+def extract_text(textExtractor, html):
+    return textExtractor(html).casefold()
 
 
 #####################################################################
-## Process account record
+# Picks the HTML to text extraction backend selected in the config
+# file.  Every backend returns the text BeautifulSoup's get_text
+# would; stream and soup both follow html.parser, while lxml follows
+# libxml2's parse of the document, as BeautifulSoup's lxml feature
+# does.
 #####################################################################
-def process_account(cacheDir, accessToken, quipUrlStrip, accountId, accountName, accountSubRegion, accountPlanUrl, csPlanUrl, searchTerms):
-    matches = 0
+def get_text_extractor(config):
+    extractor = config.get(CONFIG_KEY_TEXT_EXTRACTOR, TEXT_EXTRACTOR_STREAM).strip()
+    if (extractor == TEXT_EXTRACTOR_STREAM):
+        return extract_text_stream
+    elif (extractor == TEXT_EXTRACTOR_SOUP):
+        return extract_text_soup
+    elif (extractor == TEXT_EXTRACTOR_LXML):
+        try:
+            import lxml.etree
+        except ImportError:
+            raise SearchError("The lxml text extractor requires lxml to be installed!  pip3 install lxml")
+        return extract_text_lxml
+
+    raise SearchError("Unknown text extractor!  Expected " + TEXT_EXTRACTOR_STREAM + ", " + TEXT_EXTRACTOR_LXML + " or " + TEXT_EXTRACTOR_SOUP + " and received: " + extractor)
 
-#    print ("Cache Dir: " + cacheDir)
-#    print ("Access Token: " + accessToken)
-#    print ("Quip URL Strip: " + quipUrlStrip)
-#    print ("Account ID: " + accountId)
-#    print ("Account Name: " + accountName)
-#    print ("Account Sub Region: " + accountSubRegion)
-#    print ("Account Plan URL: " + accountPlanUrl)
-#    print ("CS Plan URL: " + csPlanUrl)
 
-    line = [ accountId, accountName, accountSubRegion, accountPlanUrl, csPlanUrl]
-    lineSearchTerms = [ ]
-    for searchTerm in searchTerms:
-        lineSearchTerms = lineSearchTerms + [ 0 ]
+#####################################################################
+# Extracts text by building a BeautifulSoup tree of the document
+#####################################################################
+def extract_text_soup(html):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, features="html.parser").get_text()
 
-# the built in search functionality for quip does not work well at all, FYI.  Reminds me of searching reddit.
-#    for searchTerm in searchTerms:
-#        search_quip(config[CONFIG_KEY_QUIP_ACCESS_TOKEN], searchTerm, config["TEST_DOC_ID"].casefold())
 
-    # Download AP Plan
-    accountPlan = get_cached_ap(cacheDir, accountId)
-    if (len(accountPlan) > 0):
-        print("Using AP Cache: " + accountId)
-    else:
-        if (len(accountPlanUrl) > 0):
-            u = accountPlanUrl.replace(quipUrlStrip, "")
-            t = u.split("/", 1)
-            if (len(t) > 1):
-                docId = t[0]
+#####################################################################
+# Extracts text by streaming the document through html.parser
+#####################################################################
+def extract_text_stream(html):
+    parser = StreamTextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.target.close()
+
+
+#####################################################################
+# Extracts text by streaming the document through lxml's parser,
+# which calls back into a target object instead of building a tree
+#####################################################################
+def extract_text_lxml(html):
+    import lxml.etree
+    parser = lxml.etree.HTMLParser(target=TextCollector())
+    parser.feed(html)
+    return parser.close()
+
+
+#####################################################################
+# Collects the text of a document from parser events, following the
+# rules BeautifulSoup applies while building its tree, so the result
+# matches get_text without a tree ever being built: runs of text
+# between two pieces of markup are kept as one string, strings made
+# only of whitespace shrink to a single space or newline outside
+# pre and textarea, and strings inside script, style, template, rt
+# and rp are set apart from the text, as are comments, declarations
+# and processing instructions.  CDATA is always kept.  The method
+# names follow lxml's parser target interface.
+#####################################################################
+class TextCollector:
+    ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+    STRING_CONTAINERS = set([ "rt", "rp", "style", "script", "template" ])
+    PRESERVE_WHITESPACE = set([ "pre", "textarea" ])
+
+    def __init__(self):
+        self.text = []
+        self.pending = []
+        self.openContainers = 0
+        self.openPreserved = 0
+
+    def start(self, tag, attrib=None):
+        self.flush()
+        if (tag in self.STRING_CONTAINERS):
+            self.openContainers += 1
+        if (tag in self.PRESERVE_WHITESPACE):
+            self.openPreserved += 1
+
+    def end(self, tag):
+        self.flush()
+        if (tag in self.STRING_CONTAINERS):
+            self.openContainers -= 1
+        if (tag in self.PRESERVE_WHITESPACE):
+            self.openPreserved -= 1
+
+    def data(self, data):
+        self.pending.append(data)
+
+    def cdata(self, data):
+        self.flush()
+        self.pending.append(data)
+        self.flush(True)
+
+    def comment(self, text):
+        self.flush()
+
+    def pi(self, target, data=None):
+        self.flush()
+
+    def doctype(self, *args):
+        self.flush()
+
+    def close(self):
+        self.flush()
+        return "".join(self.text)
+
+    # ends the current string, adding it to the text unless it sits
+    # in a string container
+    def flush(self, keep=False):
+        if (len(self.pending) == 0):
+            return
+        data = "".join(self.pending)
+        self.pending = []
+
+        if (self.openPreserved == 0) and (len(data.strip(self.ASCII_SPACES)) == 0):
+            if ("\n" in data):
+                data = "\n"
             else:
-                docId = u
-            print ("AP URL=" + accountPlanUrl + " U=" + u + " DocID=" + docId)
+                data = " "
+
+        if (keep) or (self.openContainers == 0):
+            self.text.append(data)
+
+
+#####################################################################
+# Feeds html.parser events to a TextCollector the way BeautifulSoup's
+# html.parser tree builder does: an end tag closes every tag opened
+# since its start tag and is ignored when that tag is not open, void
+# elements close as soon as they open, and character references are
+# resolved the way BeautifulSoup resolves them rather than with
+# html.unescape.
+#####################################################################
+class StreamTextExtractor(html.parser.HTMLParser):
+    VOID_ELEMENTS = set([ "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta", "param", "source", "track", "wbr",
+        "basefont", "bgsound", "command", "frame", "image", "isindex", "nextid", "spacer" ])
+    DECIMAL_REFERENCE = re.compile("^([0-9]+)(.*)")
+    HEX_REFERENCE = re.compile("^([0-9a-f]+)(.*)")
+    ENTITIES = None
+
+    def __init__(self):
+        html.parser.HTMLParser.__init__(self, convert_charrefs=False)
+        self.target = TextCollector()
+        self.openTags = []
+        self.closedVoidElements = []
+
+        if (StreamTextExtractor.ENTITIES == None):
+            # named references are recognized with or without their semicolon
+            entities = dict()
+            for name, character in sorted(html.entities.html5.items()):
+                entities.setdefault(name.rstrip(";"), character)
+            StreamTextExtractor.ENTITIES = entities
+
+    def handle_starttag(self, tag, attrs, closeVoidElement=True):
+        self.target.start(tag)
+        self.openTags.append(tag)
+        if (closeVoidElement) and (tag in self.VOID_ELEMENTS):
+            self.close_tag(tag)
+            self.closedVoidElements.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, False)
+        self.close_tag(tag)
+
+    # the end tag of a void element that was already closed is dropped
+    def handle_endtag(self, tag):
+        if (tag in self.closedVoidElements):
+            self.closedVoidElements.remove(tag)
+        else:
+            self.close_tag(tag)
+
+    def close_tag(self, tag):
+        self.target.flush()
+        if (tag not in self.openTags):
+            return
+        while (True):
+            openTag = self.openTags.pop()
+            self.target.end(openTag)
+            if (openTag == tag):
+                return
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+    def handle_entityref(self, name):
+        character = self.ENTITIES.get(name)
+        if (character == None):
+            character = "&" + name
+        self.target.data(character)
+
+    def handle_charref(self, name):
+        base = 10
+        reference = self.DECIMAL_REFERENCE
+        if (name.startswith("x") or name.startswith("X")):
+            name = name[1:]
+            base = 16
+            reference = self.HEX_REFERENCE
+
+        # an unterminated reference may carry ordinary text after the number
+        extra = ""
+        try:
+            number = int(name, base)
+        except ValueError:
+            match = reference.search(name)
+            if (match == None):
+                self.target.data(name)
+                return
+            number = int(match.group(1), base)
+            extra = match.group(2)
+
+        if (number == 0) or (number > 0x10ffff) or (0xd800 <= number <= 0xdfff):
+            character = "\ufffd"
+        elif (0x80 <= number <= 0x9f):
+            # references to windows-1252 bytes mean the windows-1252 character
             try:
-                accountPlan = get_quip_doc(accessToken, docId)
-                cache_ap(cacheDir, accountId, accountPlan)
-            except http.client.InvalidURL:
-                print ("Account Plan URL invalid!  AccountID=" + accountId + " AccountName=" + accountName + " URL=" + accountPlanUrl)
-            except quip.QuipError:
-                print ("Unable to access Account Plan URL, likely due to permissions!  AccountID=" + accountId + " AccountName=" + accountName + " URL=" + accountPlanUrl)
-            except urllib.error.HTTPError:
-                print ("Internal Server Error when pulling Account Plan URL!  AccountID=" + accountId + " AccountName=" + accountName + " URL=" + accountPlanUrl)
-            except TimeoutError:
-                print ("Timeout Error while pulling Account Plan URL!  AccountID=" + accountId + " AccountName=" + accountName + " URL=" + accountPlanUrl)
-
-    # Download CS Plan
-    csPlan = get_cached_cs(cacheDir, accountId)
-    if (len(csPlan) > 0):
-        print("Using CS Cache: " + accountId)
-    else:
-        if (len(csPlanUrl) > 0):
-            u = csPlanUrl.replace(quipUrlStrip, "")
-            t = u.split("/", 1)
-            if (len(t) > 1):
-                docId = t[0]
+                character = bytes([ number ]).decode("windows-1252")
+            except UnicodeDecodeError:
+                character = chr(number)
+        else:
+            character = chr(number)
+
+        self.target.data(character + extra)
+
+    def handle_comment(self, data):
+        self.target.comment(data)
+
+    def handle_decl(self, decl):
+        self.target.doctype(decl)
+
+    def handle_pi(self, data):
+        self.target.pi(data)
+
+    def unknown_decl(self, data):
+        if (data.upper().startswith("CDATA[")):
+            self.target.cdata(data[len("CDATA["):])
+        else:
+            self.target.doctype(data)
+
+
+#####################################################################
+# Counts every search term in a document's extracted text, giving the
+# same non-overlapping counts as str.count.  The terms are compiled
+# into an Aho-Corasick automaton once per run so each text is scanned
+# in a single pass however many terms there are.  The automaton runs
+# on pyahocorasick when it is installed; without it, the pure Python
+# automaton only pays off over the C str.count loop for long term
+# lists, so short ones are still counted term by term.
+#####################################################################
+class TermMatcher:
+    def __init__(self, searchTerms):
+        self.searchTerms = searchTerms
+
+        # duplicate terms are counted once and the count shared
+        self.patterns = list(dict.fromkeys([t.casefold() for t in searchTerms if len(t) > 0]))
+        patternIndex = dict((p, i) for i, p in enumerate(self.patterns))
+        self.termPatterns = [patternIndex.get(t.casefold()) for t in searchTerms]
+        self.lengths = [len(p) for p in self.patterns]
+
+        self.automaton = None
+        self.goto = None
+        try:
+            import ahocorasick
+            if (len(self.patterns) > 0):
+                self.automaton = ahocorasick.Automaton()
+                for i, p in enumerate(self.patterns):
+                    self.automaton.add_word(p, i)
+                self.automaton.make_automaton()
+        except ImportError:
+            if (len(self.patterns) >= AUTOMATON_MIN_TERMS):
+                self.build()
+
+    # builds the trie, failure links and outputs of the automaton
+    def build(self):
+        goto = [ dict() ]
+        out = [ [] ]
+        for i, p in enumerate(self.patterns):
+            state = 0
+            for c in p:
+                if (c not in goto[state]):
+                    goto.append(dict())
+                    out.append([])
+                    goto[state][c] = len(goto) - 1
+                state = goto[state][c]
+            out[state].append(i)
+
+        fail = [ 0 ] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for c, nextState in goto[state].items():
+                queue.append(nextState)
+                f = fail[state]
+                while (f != 0) and (c not in goto[f]):
+                    f = fail[f]
+                if (goto[f].get(c, 0) != nextState):
+                    fail[nextState] = goto[f].get(c, 0)
+                out[nextState] = out[nextState] + out[fail[nextState]]
+
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+
+    # returns the count of each search term, in search term order
+    def count(self, text):
+        counts = [ 0 ] * len(self.patterns)
+        if (self.automaton != None):
+            self.count_matches(counts, ((end + 1, i) for end, i in self.automaton.iter(text)))
+        elif (self.goto != None):
+            self.count_matches(counts, self.iter_matches(text))
+        else:
+            counts = [text.count(p) for p in self.patterns]
+
+        # str.count finds the empty string between every character
+        return [len(text) + 1 if p == None else counts[p] for p in self.termPatterns]
+
+    # matches arrive ordered by end position, and all matches of one
+    # pattern have the same length, so taking each match that starts
+    # after the previous one counted for its pattern ended reproduces
+    # str.count's leftmost non-overlapping counting
+    def count_matches(self, counts, matches):
+        lastEnd = [ 0 ] * len(self.patterns)
+        lengths = self.lengths
+        for end, i in matches:
+            if (end - lengths[i] >= lastEnd[i]):
+                counts[i] += 1
+                lastEnd[i] = end
+
+    # yields (end position, pattern index) for every match in the text
+    def iter_matches(self, text):
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        end = 0
+        for c in text:
+            end += 1
+            while (state != 0) and (c not in goto[state]):
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for i in out[state]:
+                yield end, i
+
+
+#####################################################################
+# Hashes document HTML so cached text can be checked against it
+#####################################################################
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+#####################################################################
+# Opens the document cache backend selected in the config file
+#####################################################################
+def open_cache(config, cacheDir):
+    backend = config.get(CONFIG_KEY_CACHE_BACKEND, CACHE_BACKEND_FILES).strip()
+    if (backend == CACHE_BACKEND_FILES):
+        return FileCache(cacheDir)
+    elif (backend == CACHE_BACKEND_BLOBS):
+        return BlobCache(cacheDir)
+
+    raise SearchError("Unknown cache backend!  Expected " + CACHE_BACKEND_FILES + " or " + CACHE_BACKEND_BLOBS + " and received: " + backend)
+
+
+#####################################################################
+# Document cache that keeps each Quip document as a plain HTML file
+# under docs/ named by its doc ID, with a JSON sidecar recording its
+# version, a text file of the extracted text, headed by the hash of
+# the HTML it came from, and a JSON file describing its last failed
+# download, if any
+#####################################################################
+class FileCache:
+    def __init__(self, cacheDir):
+        self.docDir = cacheDir + "/docs"
+        os.makedirs(self.docDir, exist_ok=True)
+
+    def contains(self, docId):
+        return os.path.isfile(self.filename(docId, "html"))
+
+    def get(self, docId):
+        try:
+            with open(self.filename(docId, "html"), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    # returns None when the document was cached before its info was kept
+    def get_info(self, docId):
+        try:
+            with open(self.filename(docId, "json"), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    # returns None when there is no extracted text for the current HTML
+    def get_text(self, docId):
+        html = self.get(docId)
+        if (len(html) == 0):
+            return None
+
+        try:
+            with open(self.filename(docId, "txt"), 'r') as f:
+                htmlHash = f.readline().rstrip("\n")
+                if (htmlHash != hash_text(html)):
+                    return None
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_text(self, docId, html, text):
+        write_file_atomic(self.filename(docId, "txt"), hash_text(html) + "\n" + text)
+
+    # the extracted text names the HTML it came from, so it goes stale
+    # by itself when the HTML is replaced
+    def put(self, docId, text, updatedUsec):
+        write_file_atomic(self.filename(docId, "html"), text)
+        write_file_atomic(self.filename(docId, "json"), json.dumps({ "docId": docId, "updatedUsec": updatedUsec }))
+        delete_file(self.filename(docId, "failed"))
+
+    # returns None unless the last download of the document failed
+    def get_failure(self, docId):
+        try:
+            with open(self.filename(docId, "failed"), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put_failure(self, docId, failure):
+        write_file_atomic(self.filename(docId, "failed"), json.dumps(failure))
+
+    def delete(self, docId):
+        delete_file(self.filename(docId, "html"))
+        delete_file(self.filename(docId, "json"))
+        delete_file(self.filename(docId, "txt"))
+        delete_file(self.filename(docId, "failed"))
+
+    def close(self):
+        return
+
+    def filename(self, docId, extension):
+        return self.docDir + "/" + docId + "." + extension
+
+
+#####################################################################
+# Document cache that stores zlib compressed documents once per
+# distinct content under blobs/, named by their SHA-256, and keeps a
+# SQLite manifest mapping each Quip doc ID to its blob, fetch time,
+# size and version, along with recent download failures.  Extracted
+# text is stored as a blob as well, mapped from the hash of the HTML
+# blob it came from.
+#####################################################################
+class BlobCache:
+    def __init__(self, cacheDir):
+        self.blobDir = cacheDir + "/blobs"
+        os.makedirs(self.blobDir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        import sqlite3
+        self.db = sqlite3.connect(cacheDir + "/manifest.sqlite", check_same_thread=False)
+        # documents used to be kept per account and document type; those
+        # entries are dropped and their documents downloaded once more
+        self.db.execute("DROP TABLE IF EXISTS documents")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id TEXT PRIMARY KEY,
+                blob_hash TEXT NOT NULL,
+                fetched REAL NOT NULL,
+                size INTEGER NOT NULL,
+                updated_usec INTEGER
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS texts (
+                blob_hash TEXT PRIMARY KEY,
+                text_hash TEXT NOT NULL
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS failures (
+                doc_id TEXT PRIMARY KEY,
+                category TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                failed REAL NOT NULL
+            )""")
+        self.db.commit()
+
+    def contains(self, docId):
+        return self.lookup(docId) != None
+
+    def get(self, docId):
+        row = self.lookup(docId)
+        if (row == None):
+            return ""
+
+        text = self.read_blob(row[0])
+        if (text == None):
+            return ""
+        return text
+
+    # the manifest already holds the HTML hash, so the HTML is never read
+    def get_text(self, docId):
+        with self.lock:
+            row = self.db.execute("SELECT t.text_hash FROM docs d JOIN texts t ON t.blob_hash = d.blob_hash WHERE d.doc_id = ?",
+                (docId,)).fetchone()
+        if (row == None):
+            return None
+        return self.read_blob(row[0])
+
+    def put_text(self, docId, html, text):
+        textHash = self.write_blob(text)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO texts VALUES (?, ?)", (hash_text(html), textHash))
+            self.db.commit()
+
+    def get_info(self, docId):
+        row = self.lookup(docId)
+        if (row == None):
+            return None
+        return { "docId": docId, "updatedUsec": row[1] }
+
+    def put(self, docId, text, updatedUsec):
+        blobHash = self.write_blob(text)
+        with self.lock:
+            row = self.db.execute("SELECT blob_hash FROM docs WHERE doc_id = ?", (docId,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?)",
+                (docId, blobHash, time.time(), len(text.encode("utf-8")), updatedUsec))
+            self.db.execute("DELETE FROM failures WHERE doc_id = ?", (docId,))
+            if (row != None) and (row[0] != blobHash):
+                self.release_blob(row[0])
+            self.db.commit()
+
+    def get_failure(self, docId):
+        with self.lock:
+            row = self.db.execute("SELECT category, reason, failed FROM failures WHERE doc_id = ?", (docId,)).fetchone()
+        if (row == None):
+            return None
+        return { "category": row[0], "reason": row[1], "failed": row[2], "skipped": False }
+
+    def put_failure(self, docId, failure):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?)",
+                (docId, failure["category"], failure["reason"], failure["failed"]))
+            self.db.commit()
+
+    def delete(self, docId):
+        with self.lock:
+            row = self.db.execute("SELECT blob_hash FROM docs WHERE doc_id = ?", (docId,)).fetchone()
+            self.db.execute("DELETE FROM docs WHERE doc_id = ?", (docId,))
+            self.db.execute("DELETE FROM failures WHERE doc_id = ?", (docId,))
+            if (row != None):
+                self.release_blob(row[0])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # removes an HTML blob no document uses any more, with its extracted
+    # text, unless other documents share them; called holding the lock.
+    # Should another process write the same content meanwhile, the
+    # blob it finds missing is written again when next needed.
+    def release_blob(self, blobHash):
+        if (self.db.execute("SELECT 1 FROM docs WHERE blob_hash = ?", (blobHash,)).fetchone() != None):
+            return
+
+        unused = [ blobHash ]
+        row = self.db.execute("SELECT text_hash FROM texts WHERE blob_hash = ?", (blobHash,)).fetchone()
+        if (row != None):
+            self.db.execute("DELETE FROM texts WHERE blob_hash = ?", (blobHash,))
+            unused.append(row[0])
+
+        for unusedHash in unused:
+            if (self.db.execute("SELECT 1 FROM docs WHERE blob_hash = ? UNION ALL SELECT 1 FROM texts WHERE text_hash = ?",
+                    (unusedHash, unusedHash)).fetchone() == None):
+                delete_file(self.blob_filename(unusedHash))
+
+    def lookup(self, docId):
+        with self.lock:
+            return self.db.execute("SELECT blob_hash, updated_usec FROM docs WHERE doc_id = ?", (docId,)).fetchone()
+
+    # identical content shares one blob, so only unseen content is written
+    def write_blob(self, text):
+        blobHash = hash_text(text)
+        filename = self.blob_filename(blobHash)
+        if (not os.path.isfile(filename)):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tempFilename = filename + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+            with open(tempFilename, 'wb') as f:
+                f.write(zlib.compress(text.encode("utf-8")))
+            os.replace(tempFilename, filename)
+
+        return blobHash
+
+    # a corrupt blob is deleted and treated as missing, so that its
+    # document is downloaded and the blob written again
+    def read_blob(self, blobHash):
+        filename = self.blob_filename(blobHash)
+        try:
+            with open(filename, 'rb') as f:
+                return zlib.decompress(f.read()).decode("utf-8")
+        except FileNotFoundError:
+            return None
+        except zlib.error:
+            delete_file(filename)
+            return None
+
+    def blob_filename(self, blobHash):
+        return self.blobDir + "/" + blobHash[:2] + "/" + blobHash + ".z"
+
+
+#####################################################################
+# Opens the search index of the given kind, or returns None when the
+# cached documents are scanned instead
+#####################################################################
+def open_search_index(kind, cacheDir, searchTerms):
+    if (kind == SEARCH_INDEX_NONE):
+        return None
+    elif (kind == SEARCH_INDEX_FTS):
+        return FtsIndex(cacheDir, searchTerms)
+    elif (kind == SEARCH_INDEX_TRIGRAM):
+        return TrigramIndex(cacheDir, searchTerms)
+    elif (kind == SEARCH_INDEX_CORPUS):
+        return CorpusIndex(cacheDir, searchTerms)
+
+    raise SearchError("Unknown search index!  Expected " + SEARCH_INDEX_NONE + ", " + SEARCH_INDEX_FTS + ", " + SEARCH_INDEX_TRIGRAM +
+        " or " + SEARCH_INDEX_CORPUS + " and received: " + kind)
+
+
+#####################################################################
+# Index of the cached documents' text, kept in an SQLite FTS5 table
+# of index.sqlite along with the version of each document it holds,
+# and the accounts and document types linking to each document.  The
+# kinds of index differ in how the text is tokenized, and so in how
+# each term is looked up and counted: lookupTerm returns the MATCH
+# query finding the documents a casefolded term may be in, or None to
+# read every document, the token whose instances in the index are the
+# term's count, or None when the term is counted in the text, and the
+# function counting the term in a document's text.  The instances of
+# each token are read from the index once per run, so documents put
+# after that are counted in their text instead.
+#####################################################################
+class SqliteIndex:
+    def __init__(self, cacheDir, searchTerms, docTable, textTable, tokenize, lookupTerm):
+        import sqlite3
+
+        self.docTable = docTable
+        self.textTable = textTable
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(cacheDir + "/" + INDEX_FILENAME, check_same_thread=False)
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS " + textTable + " USING fts5(text, tokenize='" + tokenize + "')")
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp." + textTable + "_instances USING fts5vocab(main, " + textTable + ", instance)")
+        except sqlite3.OperationalError as e:
+            raise SearchError("Unable to create the search index, SQLite may be too old or built without FTS5!  " + str(e))
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS """ + docTable + """ (
+                id INTEGER PRIMARY KEY,
+                doc_id TEXT NOT NULL UNIQUE,
+                updated_usec INTEGER
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS account_docs (
+                account_id TEXT NOT NULL,
+                doc_type TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                PRIMARY KEY (account_id, doc_type)
+            )""")
+        self.db.commit()
+
+        # each distinct term is looked up once: casefolded term ->
+        # (MATCH query, token, function counting it in a document's text)
+        self.searchTerms = [t.casefold() for t in searchTerms]
+        self.terms = dict((t, lookupTerm(t)) for t in self.searchTerms)
+
+        # term -> {rowid: count}, for the terms that are a single token,
+        # along with the rowids put since, whose instances aren't in it
+        self.instances = None
+        self.putRowIds = set()
+
+    # true when the index holds the given version of the document
+    def contains(self, docId, updatedUsec):
+        with self.lock:
+            row = self.db.execute("SELECT updated_usec FROM " + self.docTable + " WHERE doc_id = ?", (docId,)).fetchone()
+        return (row != None) and (row[0] == updatedUsec)
+
+    # adds the document's text, replacing any older version of it
+    def put(self, docId, text, updatedUsec):
+        with self.lock:
+            row = self.db.execute("SELECT id FROM " + self.docTable + " WHERE doc_id = ?", (docId,)).fetchone()
+            if (row == None):
+                rowId = self.db.execute("INSERT INTO " + self.docTable + " (doc_id, updated_usec) VALUES (?, ?)", (docId, updatedUsec)).lastrowid
             else:
-                docId = u
-            print ("CS Doc ID = " + docId)
-            try:
-                csPlan = get_quip_doc(accessToken, docId)
-                cache_cs(cacheDir, accountId, csPlan)
-            except http.client.InvalidURL:
-                print ("CS Plan URL invalid!  AccountID=" + accountId + " AccountName=" + accountName + " URL=" + csPlanUrl)
-            except quip.QuipError:
-                print ("Unable to access CS Plan URL, likely due to permissions!  AccountID=" + accountId + " AccountName=" + accountName + " URL=" + csPlanUrl)
-            except urllib.error.HTTPError:
-                print ("Internal Server Error when pulling CS Plan URL!  AccountID=" + accountId + " AccountName=" + accountName + " URL=" + csPlanUrl)
-            except TimeoutError:
-                print ("Timeout Error while pulling CS Plan URL!  AccountID=" + accountId + " AccountName=" + accountName + " URL=" + csPlanUrl)
-
-    accountPlanSoup = None
-    if (accountPlan != ""):
-        accountPlanSoup = BeautifulSoup(accountPlan, features="html.parser")
-    csPlanSoup = None
-    if (csPlan != ""):
-        csPlanSoup = BeautifulSoup(csPlan, features="html.parser")
-
-    searchTermIndex = 0
-    for searchTerm in searchTerms:
+                rowId = row[0]
+                self.db.execute("UPDATE " + self.docTable + " SET updated_usec = ? WHERE id = ?", (updatedUsec, rowId))
+                self.db.execute("DELETE FROM " + self.textTable + " WHERE rowid = ?", (rowId,))
+            self.db.execute("INSERT INTO " + self.textTable + " (rowid, text) VALUES (?, ?)", (rowId, text.casefold()))
+            self.db.commit()
+            if (self.instances != None):
+                self.putRowIds.add(rowId)
+
+    # records the documents each account links to, as (doc type, URL,
+    # doc ID) tuples per account ID
+    def tag_accounts(self, accounts):
+        with self.lock:
+            for accountId, docIds in accounts:
+                self.db.execute("DELETE FROM account_docs WHERE account_id = ?", (accountId,))
+                self.db.executemany("INSERT INTO account_docs VALUES (?, ?, ?)",
+                    [(accountId, docType, docId) for docType, url, docId in docIds])
+            self.db.commit()
+
+    # returns the count of each search term, in search term order, for
+    # each of the given documents the index holds
+    def count(self, docIds):
+        with self.lock:
+            placeholders = ",".join("?" * len(docIds))
+            rowIds = dict(self.db.execute("SELECT id, doc_id FROM " + self.docTable + " WHERE doc_id IN (" + placeholders + ")", docIds))
+
+            # terms that are a single token are counted by the index
+            # itself, reading each token's instances in one query, as
+            # the vocabulary table can't look up a single document
+            if (self.instances == None):
+                self.instances = dict()
+                for term, (query, token, counter) in self.terms.items():
+                    if (token != None):
+                        self.instances[term] = dict(self.db.execute("SELECT doc, COUNT(*) FROM temp." + self.textTable + "_instances" +
+                            " WHERE term = ? GROUP BY doc", (token,)))
+
+            # only the documents the index finds any other term in, or
+            # that were put since the instances were read, are read to
+            # count it
+            placeholders = ",".join("?" * len(rowIds))
+            changed = any((rowId in self.putRowIds) for rowId in rowIds)
+            candidates = dict()
+            for term, (query, token, counter) in self.terms.items():
+                if (query != None) and ((token == None) or changed):
+                    candidates[term] = set(row[0] for row in self.db.execute("SELECT rowid FROM " + self.textTable +
+                        " WHERE " + self.textTable + " MATCH ? AND rowid IN (" + placeholders + ")", [ query ] + list(rowIds)))
+
+            counts = dict()
+            for rowId, docId in rowIds.items():
+                text = None
+                termCounts = dict()
+                for term, (query, token, counter) in self.terms.items():
+                    if (token != None) and (rowId not in self.putRowIds):
+                        termCounts[term] = self.instances[term].get(rowId, 0)
+                        continue
+                    if (query != None) and (rowId not in candidates[term]):
+                        termCounts[term] = 0
+                        continue
+                    if (text == None):
+                        text = self.db.execute("SELECT text FROM " + self.textTable + " WHERE rowid = ?", (rowId,)).fetchone()[0]
+                    termCounts[term] = counter(text)
+                counts[docId] = [termCounts[t] for t in self.searchTerms]
+
+        return counts
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+#####################################################################
+# Full-text index, which can be queried directly as well:
+#
+#     SELECT a.account_id, a.doc_type FROM doc_text t
+#         JOIN index_docs d ON d.id = t.rowid
+#         JOIN account_docs a ON a.doc_id = d.doc_id
+#         WHERE doc_text MATCH 'kubernetes'
+#
+# Its counts are word level, unlike the substring counts of a scan: a
+# term only counts where it appears as whole words, so "kube" doesn't
+# count "kubernetes", and punctuation in a term or the text is just a
+# break between words.  The text is indexed casefolded, so case is
+# ignored the same way as in a scan.  Terms without letters or digits,
+# like "&", can't be looked up and are counted as substrings of every
+# document.
+#####################################################################
+class FtsIndex(SqliteIndex):
+    def __init__(self, cacheDir, searchTerms):
+        super().__init__(cacheDir, searchTerms, "index_docs", "doc_text", "unicode61 remove_diacritics 0", lookup_fts_term)
+
+
+#####################################################################
+# Looks up a casefolded term in the full-text index, as the phrase of
+# its words.  A single word is counted from the index's instances of
+# it, while a phrase is counted in the text of the documents holding
+# it: each hit of its first word found with str.find is checked for
+# the rest of the words, with only breaks between words in between,
+# and for word boundaries at either end.
+#####################################################################
+def lookup_fts_term(term):
+    words = get_index_words(term)
+    if (len(words) == 0):
+        return (None, None, lambda text: text.count(term))
+
+    def count_phrase(text):
         count = 0
-        if (accountPlanSoup != None):
-            count += accountPlanSoup.get_text().casefold().count(searchTerm.casefold())
-        if (csPlanSoup != None):
-            count += csPlanSoup.get_text().casefold().count(searchTerm.casefold())
+        start = text.find(words[0])
+        while (start != -1):
+            end = match_index_phrase(text, start, words)
+            if (end != -1):
+                count = count + 1
+                start = text.find(words[0], end)
+            else:
+                start = text.find(words[0], start + 1)
+        return count
 
-        lineSearchTerms[searchTermIndex] = count
-        searchTermIndex += 1
+    return ("\"" + " ".join(words) + "\"", words[0] if (len(words) == 1) else None, count_phrase)
 
-    lineSearchTerms = [str(x) for x in lineSearchTerms]
-    return line + lineSearchTerms
+
+#####################################################################
+# Returns where the phrase of the given words ends when it appears as
+# whole words at start of the text, or -1 when it doesn't
+#####################################################################
+def match_index_phrase(text, start, words):
+    i = start - 1
+    while (i >= 0) and (unicodedata.category(text[i]) == "Mn"):
+        i = i - 1
+    if (i >= 0) and is_index_word_start(text[i]):
+        return -1
+
+    end = start + len(words[0])
+    for word in words[1:]:
+        if (end < len(text)) and is_index_word_character(text[end]):
+            return -1
+        while (end < len(text)) and not is_index_word_start(text[end]):
+            end = end + 1
+        if not text.startswith(word, end):
+            return -1
+        end = end + len(word)
+
+    if (end < len(text)) and is_index_word_character(text[end]):
+        return -1
+    return end
+
+
+#####################################################################
+# Splits text into the words FTS5's unicode61 tokenizer would index
+#####################################################################
+def get_index_words(text):
+    words = []
+    start = None
+    for i in range(len(text)):
+        if (start == None):
+            if is_index_word_start(text[i]):
+                start = i
+        elif not is_index_word_character(text[i]):
+            words.append(text[start:i])
+            start = None
+    if (start != None):
+        words.append(text[start:])
+    return words
 
 
 #####################################################################
-## Query SFDC for a list of Quip Documents to search
+# True for the characters FTS5's unicode61 tokenizer starts a word
+# with: letters, numbers and private use characters
 #####################################################################
-def sfdc_query(cacheDir, config):
+def is_index_word_start(c):
+    category = unicodedata.category(c)
+    return (category[0] in "LN") or (category == "Co")
+
+
+#####################################################################
+# True for the characters FTS5's unicode61 tokenizer keeps in a word
+# once it has started, which are nonspacing marks as well, so that
+# the dot of "i̇", a casefolded "İ", doesn't split the word it is in.
+# Python's \w differs on the marks, private use characters and "_",
+# so the Unicode category is checked instead.
+#####################################################################
+def is_index_word_character(c):
+    return is_index_word_start(c) or (unicodedata.category(c) == "Mn")
+
+
+#####################################################################
+# Trigram index, giving exactly the counts of a scan: every run of
+# three characters in the casefolded text is indexed, so a term's
+# trigrams find just the documents holding it as a substring, and
+# only those are read and counted with str.count as a scan does.
+# Terms shorter than three characters have no trigram to look up, so
+# every document is read to count them.
+#####################################################################
+class TrigramIndex(SqliteIndex):
+    def __init__(self, cacheDir, searchTerms):
+        super().__init__(cacheDir, searchTerms, "trigram_docs", "trigram_text", "trigram case_sensitive 1", lookup_trigram_term)
+
+
+#####################################################################
+# Looks up a casefolded term in the trigram index, as a substring
+#####################################################################
+def lookup_trigram_term(term):
+    if (len(term) < 3):
+        return (None, None, lambda text: text.count(term))
+    return ("\"" + term.replace("\"", "\"\"") + "\"", None, lambda text: text.count(term))
+
+
+#####################################################################
+# Corpus of the cached documents' casefolded UTF-8 text, back to back
+# in one file under corpus/ with a NUL after each, and a manifest of
+# the span and version of each document.  The file is memory mapped
+# and each term is matched over the whole of it in one pass, without
+# opening, reading or decoding a file per document; the hits are then
+# mapped back to documents through the span offsets, with NumPy's
+# searchsorted when it is installed.  Counts are exactly those of a
+# scan, as matching UTF-8 bytes finds the same non-overlapping
+# matches str.count does, and no match can run past a document.
+#
+# Documents that change are appended again, leaving their old text
+# unused until the corpus is compacted, which happens when a run
+# leaves more unused than live text behind.  Each compaction writes a
+# new file before the manifest is pointed at it, so an interrupted
+# run always leaves a usable corpus.
+#####################################################################
+class CorpusIndex:
+    def __init__(self, cacheDir, searchTerms):
+        self.corpusDir = cacheDir + "/corpus"
+        os.makedirs(self.corpusDir, exist_ok=True)
+        self.lock = threading.Lock()
+
+        # doc ID -> [start, end, length in characters, updated usec]
+        self.docs = dict()
+        self.generation = 0
+        self.size = 0
+        try:
+            with open(self.corpusDir + "/" + CORPUS_MANIFEST_FILENAME, 'r') as f:
+                manifest = json.load(f)
+            if (os.path.isfile(self.filename(manifest["generation"]))):
+                self.docs = manifest["docs"]
+                self.generation = manifest["generation"]
+                self.size = manifest["size"]
+        except (FileNotFoundError, ValueError):
+            pass
+
+        # anything past the manifest's size was appended by a run that
+        # didn't finish, and isn't part of any span
+        self.file = open(self.filename(self.generation), 'ab+')
+        self.file.truncate(self.size)
+        self.map = None
+        self.changed = False
+
+        # counts from matching the whole corpus, by span start; spans
+        # appended afterwards are matched on their own
+        self.scanned = None
+
+        # like TermMatcher, each distinct term is matched once
+        self.searchTerms = [t.casefold() for t in searchTerms]
+        self.patterns = list(dict.fromkeys([t for t in self.searchTerms if len(t) > 0]))
+        patternIndex = dict((p, i) for i, p in enumerate(self.patterns))
+        self.termPatterns = [patternIndex.get(t) for t in self.searchTerms]
+        self.expressions = [re.compile(re.escape(p.encode("utf-8"))) for p in self.patterns]
+
+    # true when the corpus holds the given version of the document
+    def contains(self, docId, updatedUsec):
+        with self.lock:
+            doc = self.docs.get(docId)
+        return (doc != None) and (doc[3] == updatedUsec)
+
+    # appends the document's text, leaving any older version unused
+    def put(self, docId, text, updatedUsec):
+        text = text.casefold()
+        data = text.encode("utf-8")
+        with self.lock:
+            self.file.write(data + b"\0")
+            self.docs[docId] = [self.size, self.size + len(data), len(text), updatedUsec]
+            self.size = self.size + len(data) + 1
+            self.changed = True
+
+    # accounts are mapped to their documents' spans by the run itself
+    def tag_accounts(self, accounts):
+        return
+
+    # returns the count of each search term, in search term order, for
+    # each of the given documents the corpus holds
+    def count(self, docIds):
+        with self.lock:
+            if (self.map == None) or (len(self.map) < self.size):
+                self.remap()
+            if (self.scanned == None):
+                self.scanned = self.scan()
+
+            counts = dict()
+            for docId in docIds:
+                doc = self.docs.get(docId)
+                if (doc == None):
+                    continue
+
+                start, end, length, updatedUsec = doc
+                patternCounts = self.scanned.get(start)
+                if (patternCounts == None):
+                    patternCounts = [sum(1 for m in e.finditer(self.map, start, end)) for e in self.expressions]
+
+                # str.count finds the empty string between every character
+                counts[docId] = [length + 1 if p == None else patternCounts[p] for p in self.termPatterns]
+
+        return counts
+
+    # matches each term over the whole corpus and maps every hit to the
+    # span holding it, returning the counts by span start
+    def scan(self):
+        spans = sorted((doc[0], doc[1]) for doc in self.docs.values())
+        starts = [span[0] for span in spans]
+        ends = [span[1] for span in spans]
+        if (len(spans) == 0):
+            return dict()
+
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        spanCounts = []
+        for e in self.expressions:
+            hits = [m.start() for m in e.finditer(self.map)]
+            if (numpy != None):
+                hits = numpy.array(hits, dtype=numpy.int64)
+                spanIndexes = numpy.searchsorted(numpy.array(starts, dtype=numpy.int64), hits, side="right") - 1
+                # hits in text no document uses any more belong to no span
+                live = (spanIndexes >= 0) & (hits < numpy.array(ends, dtype=numpy.int64)[spanIndexes])
+                spanCounts.append(numpy.bincount(spanIndexes[live], minlength=len(spans)).tolist())
+            else:
+                patternCounts = [ 0 ] * len(spans)
+                for hit in hits:
+                    i = bisect.bisect_right(starts, hit) - 1
+                    if (i >= 0) and (hit < ends[i]):
+                        patternCounts[i] += 1
+                spanCounts.append(patternCounts)
+
+        return dict((starts[i], [c[i] for c in spanCounts]) for i in range(len(spans)))
+
+    def remap(self):
+        if (self.map != None):
+            self.map.close()
+        self.file.flush()
+        self.map = None
+        if (self.size > 0):
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+
+    def close(self):
+        with self.lock:
+            live = sum(doc[1] - doc[0] + 1 for doc in self.docs.values())
+            if (live * 2 < self.size):
+                self.compact()
+
+            if (self.map != None):
+                self.map.close()
+            self.file.close()
+            if (self.changed):
+                self.write_manifest()
+
+    # copies the live spans into a new file, in corpus order
+    def compact(self):
+        self.remap()
+        generation = self.generation + 1
+        size = 0
+        with open(self.filename(generation), 'wb') as f:
+            for doc in sorted(self.docs.values()):
+                length = doc[1] - doc[0]
+                f.write(self.map[doc[0]:doc[1] + 1])
+                doc[0] = size
+                doc[1] = size + length
+                size = size + length + 1
+
+        oldFilename = self.filename(self.generation)
+        self.map.close()
+        self.map = None
+        self.file.close()
+        self.file = open(self.filename(generation), 'ab+')
+        self.generation = generation
+        self.size = size
+        self.write_manifest()
+        delete_file(oldFilename)
+
+    def write_manifest(self):
+        write_file_atomic(self.corpusDir + "/" + CORPUS_MANIFEST_FILENAME,
+            json.dumps({ "generation": self.generation, "size": self.size, "docs": self.docs }))
+        self.changed = False
+
+    def filename(self, generation):
+        return self.corpusDir + "/corpus." + str(generation) + ".bin"
+
+
+#####################################################################
+## Builds the report row for a SOQL line and its term counts, which
+## are kept as numbers for the report to write as it needs
+#####################################################################
+def get_account_row(line, counts):
+    return [x.strip() for x in line[:REPORT_ACCOUNT_COLUMNS]] + counts
+
+
+#####################################################################
+## Counts the search terms in each of the given Quip documents.
+## Returns a (counts, fetch error) pair per document; counts is None
+## when the document couldn't be pulled or is empty.
+#####################################################################
+def search_docs(cache, client, docIds, matcher, textExtractor, fetchErrors):
+    return [search_doc(cache, client, docId, matcher, textExtractor, fetchErrors.get(docId)) for docId in docIds]
+
+
+#####################################################################
+## Counts the search terms in a Quip document, using its extracted
+## text from the cache, its HTML from the cache or Quip in that order
+#####################################################################
+def search_doc(cache, client, docId, matcher, textExtractor, fetchError):
+    if (fetchError != None):
+        return (None, fetchError)
+
+    with metrics.timer("cache_read"):
+        text = cache.get_text(docId)
+    if (text != None):
+        print("Using Text Cache: " + docId)
+        metrics.add("text_cache_hits")
+        with metrics.timer("match"):
+            return (matcher.count(text), None)
+
+    metrics.add("text_cache_misses")
+    with metrics.timer("cache_read"):
+        html = cache.get(docId)
+    if (len(html) > 0):
+        print("Using Cache: " + docId)
+    else:
+        print ("Downloading DocID=" + docId)
+        try:
+            with metrics.timer("quip_request"):
+                thread = get_quip_doc(client, docId)
+            html = thread['html']
+            metrics.add("docs_downloaded")
+            metrics.add("downloaded_bytes", len(html.encode("utf-8")))
+            with metrics.timer("cache_write"):
+                cache.put(docId, html, thread['thread']['updated_usec'])
+        except (http.client.InvalidURL, quip.QuipError, urllib.error.HTTPError, TimeoutError) as e:
+            metrics.error(e)
+            return (None, get_fetch_error(e))
+
+    if (len(html) == 0):
+        return (None, None)
+
+    with metrics.timer("extract"):
+        text = extract_text(textExtractor, html)
+    with metrics.timer("cache_write"):
+        cache.put_text(docId, html, text)
+    with metrics.timer("match"):
+        return (matcher.count(text), None)
+
+
+#####################################################################
+## Counts the search terms in each of the given Quip documents with
+## the search index, first indexing the cached version of those it
+## doesn't hold yet.  Returns the same (counts, fetch error) pairs as
+## search_docs.
+#####################################################################
+def search_docs_indexed(cache, index, docIds, textExtractor, fetchErrors):
+    indexed = []
+    for docId in docIds:
+        if (docId not in fetchErrors) and (index_doc(cache, index, docId, textExtractor)):
+            indexed.append(docId)
+
+    with metrics.timer("index_query"):
+        counts = index.count(indexed)
+    return [(None, fetchErrors[docId]) if docId in fetchErrors else (counts.get(docId), None) for docId in docIds]
+
+
+#####################################################################
+## Makes sure the search index holds the cached version of a Quip
+## document.  Returns False when the document isn't cached or empty.
+#####################################################################
+def index_doc(cache, index, docId, textExtractor):
+    info = cache.get_info(docId)
+    updatedUsec = None if info == None else info.get("updatedUsec")
+    if (index.contains(docId, updatedUsec)):
+        return True
+
+    with metrics.timer("cache_read"):
+        text = cache.get_text(docId)
+    if (text == None):
+        with metrics.timer("cache_read"):
+            html = cache.get(docId)
+        if (len(html) == 0):
+            return False
+
+        with metrics.timer("extract"):
+            text = extract_text(textExtractor, html)
+        with metrics.timer("cache_write"):
+            cache.put_text(docId, html, text)
+
+    print ("Indexing DocID=" + docId)
+    with metrics.timer("index_write"):
+        index.put(docId, text, updatedUsec)
+    metrics.add("docs_indexed")
+    return True
+
+
+#####################################################################
+## Describes a failed Quip download: its category, the error text,
+## when it failed and whether it was skipped as a known failure
+#####################################################################
+def get_fetch_error(e):
+    return { "category": get_fetch_error_category(e), "reason": str(e), "failed": time.time(), "skipped": False }
+
+
+#####################################################################
+## Classifies a failed Quip download
+#####################################################################
+def get_fetch_error_category(e):
+    if (isinstance(e, http.client.InvalidURL)):
+        return FETCH_ERROR_INVALID_URL
+    elif (isinstance(e, quip.QuipError)):
+        return FETCH_ERROR_ACCESS
+    elif (isinstance(e, urllib.error.HTTPError)):
+        return FETCH_ERROR_SERVER
+    return FETCH_ERROR_TIMEOUT
+
+
+#####################################################################
+## Reports a failed Quip download for an account's document
+#####################################################################
+def print_fetch_error(error, docType, accountId, accountName, url):
+    label = DOC_TYPE_LABELS[docType]
+    details = "  AccountID=" + accountId + " AccountName=" + accountName + " URL=" + url
+    category = error["category"]
+
+    if (category == FETCH_ERROR_INVALID_URL):
+        print (label + " URL invalid!" + details)
+    elif (category == FETCH_ERROR_ACCESS):
+        print ("Unable to access " + label + " URL, likely due to permissions!" + details)
+    elif (category == FETCH_ERROR_SERVER):
+        print ("Internal Server Error when pulling " + label + " URL!" + details)
+    else:
+        print ("Timeout Error while pulling " + label + " URL!" + details)
+
+
+#####################################################################
+## Sets up a search process: each one opens its own cache and Quip
+## client and builds its own matcher
+#####################################################################
+searchProcess = dict()
+
+def init_search_process(config, cacheDir, searchTerms):
+    load_quip()
+    searchProcess["cache"] = open_cache(config, cacheDir)
+    searchProcess["client"] = quip.QuipClient(access_token=config[CONFIG_KEY_QUIP_ACCESS_TOKEN].strip(), base_url=config.get(CONFIG_KEY_QUIP_BASE_URL))
+    searchProcess["matcher"] = TermMatcher(searchTerms)
+    searchProcess["textExtractor"] = get_text_extractor(config)
+
+
+#####################################################################
+## Searches a chunk of Quip documents inside a search process,
+## returning the metrics collected along with the results
+#####################################################################
+def search_docs_in_process(docIds, fetchErrors):
+    metrics.reset()
+    results = search_docs(searchProcess["cache"], searchProcess["client"], docIds,
+        searchProcess["matcher"], searchProcess["textExtractor"], fetchErrors)
+    return results, metrics.snapshot()
+
+
+#####################################################################
+## Query SFDC for a list of Quip Documents to search.  Yields the
+## header and then each account row as the source produces them,
+## either the sfdx CLI or the Salesforce REST API (SFDC_SOURCE).  The
+## result is kept in the cache directory under a hash of the query
+## and who it ran as, and reused until it is older than
+## SOQL_CACHE_TTL seconds, unless refresh is set.
+#####################################################################
+def sfdc_query(cacheDir, config, refresh):
 
     sqlQuery = config[CONFIG_KEY_SFDC_QUERY].strip()
     if (sqlQuery.casefold()[:6] != "select"):
-        print ("Only SELECT statements are appropriate for use!  Query=" + sqlQuery)
-        sys.exit()
+        raise SearchError("Only SELECT statements are appropriate for use!  Query=" + sqlQuery)
     else:
         print ("SOQL statement validated to to be a query...")
-    
+
+    source = config.get(CONFIG_KEY_SFDC_SOURCE, SFDC_SOURCE_SFDX).strip()
+    if (source == SFDC_SOURCE_SFDX):
+        identity = config[CONFIG_KEY_SFDC_USERNAME].strip()
+    elif (source == SFDC_SOURCE_REST):
+        # the token stands in for who the query runs as, since users of
+        # the same org may see different accounts
+        accessToken = config[CONFIG_KEY_SFDC_ACCESS_TOKEN].strip()
+        identity = config[CONFIG_KEY_SFDC_INSTANCE_URL].strip() + "\n" + hashlib.sha256(accessToken.encode("utf-8")).hexdigest()
+    else:
+        raise SearchError("Unknown SFDC source!  Expected " + SFDC_SOURCE_SFDX + " or " + SFDC_SOURCE_REST + " and received: " + source)
+
+    queryHash = hashlib.sha256((identity + "\n" + sqlQuery).encode("utf-8")).hexdigest()
+    filename = cacheDir + "/soql_" + queryHash + ".csv"
+    ttl = int(config.get(CONFIG_KEY_SOQL_CACHE_TTL, DEFAULT_SOQL_CACHE_TTL))
+
+    if (not refresh) and (ttl > 0) and os.path.isfile(filename):
+        age = time.time() - os.path.getmtime(filename)
+        if (age < ttl):
+            print ("Using SOQL Cache: " + filename + " (" + str(int(age)) + " seconds old)")
+            with open(filename, 'r') as f:
+                for row in read_soql_rows(f):
+                    yield row
+            return
+
+    # every row is written to a temporary file as it is read, which
+    # only replaces the cached result once the query has completed;
+    # shards started together may each run the query at the same time
+    tempFilename = filename + "." + str(os.getpid()) + ".tmp"
+    delete_file(tempFilename)
+    with open(tempFilename, 'x') as f:
+        if (source == SFDC_SOURCE_REST):
+            rows = sfdc_rest_query(config, sqlQuery, f)
+        else:
+            rows = sfdx_query(config, sqlQuery, f)
+
+        complete = False
+        try:
+            for row in rows:
+                yield row
+            complete = True
+        finally:
+            # a run that stops early, on an error or once it has enough
+            # accounts, stops the query rather than reading the rest of
+            # it, and leaves the cached result as it was
+            rows.close()
+            f.close()
+            if (complete):
+                os.replace(tempFilename, filename)
+            else:
+                delete_file(tempFilename)
+
+
+#####################################################################
+## Runs the SOQL query through the sfdx CLI, copying its CSV output
+## to f and yielding the header and rows as they are written out
+#####################################################################
+def sfdx_query(config, sqlQuery, f):
     print ("Executing SOQL query to search for Quip documents now using SFDX...  Expecting that you have already authenticated prior to running this script.")
     command = [
         "sfdx",
@@ -271,35 +2296,386 @@ def sfdc_query(cacheDir, config):
         "-r",
         "csv"
     ]
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    stdout, stderrr = process.communicate()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+
+    def read_lines():
+        for line in process.stdout:
+            f.write(line)
+            yield line
+
+    try:
+        for row in read_soql_rows(read_lines()):
+            yield row
+        process.wait()
+    finally:
+        if (process.poll() == None):
+            process.kill()
+            process.wait()
+
     if (process.returncode != 0):
-        print ("An error occurred while executing the SOQL query through SFDX!  Return Code=" + str(process.returncode))
-        sys.exit()
+        raise SearchError("An error occurred while executing the SOQL query through SFDX!  Return Code=" + str(process.returncode))
+
+
+#####################################################################
+## Runs the SOQL query through the Salesforce REST API, following
+## nextRecordsUrl from page to page.  The next page is requested in
+## the background while the current one is being yielded, so work on
+## the first accounts starts while later pages are still loading.
+## Rows are written to f in the same CSV form sfdx produces.
+#####################################################################
+def sfdc_rest_query(config, sqlQuery, f):
+    instanceUrl = config[CONFIG_KEY_SFDC_INSTANCE_URL].strip().rstrip("/")
+    accessToken = config[CONFIG_KEY_SFDC_ACCESS_TOKEN].strip()
+    apiVersion = config.get(CONFIG_KEY_SFDC_API_VERSION, DEFAULT_SFDC_API_VERSION).strip()
 
-    filename = cacheDir + "/soql.csv"
-    delete_file(filename)
-    with open(filename, 'x') as f:
-        f.write(stdout)
+    print ("Executing SOQL query to search for Quip documents now using the Salesforce REST API...  Instance=" + instanceUrl)
+    url = instanceUrl + "/services/data/" + apiVersion + "/query?" + urllib.parse.urlencode({ "q": sqlQuery })
 
-    return stdout
+    pages = queue.Queue(maxsize=1)
+    stopped = threading.Event()
+
+    # gives up once the query is stopped, rather than waiting for room
+    def put_page(page):
+        while (not stopped.is_set()):
+            try:
+                pages.put(page, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load_pages(url):
+        try:
+            while (url != None):
+                page = sfdc_rest_get(url, accessToken)
+                if (not put_page(page)):
+                    return
+                if (page.get("done", True)) or (not page.get("nextRecordsUrl")):
+                    url = None
+                else:
+                    url = instanceUrl + page["nextRecordsUrl"]
+            put_page(None)
+        except Exception as e:
+            put_page(e)
+
+    threading.Thread(target=load_pages, args=(url,), daemon=True).start()
+
+    csvWriter = csv.writer(f, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL, lineterminator="\n")
+    header = None
+    try:
+        while True:
+            page = pages.get()
+            if (page == None):
+                break
+            if (isinstance(page, Exception)):
+                raise SearchError("An error occurred while executing the SOQL query through the Salesforce REST API!  Error=" + str(page))
+
+            for record in page.get("records", []):
+                fields = flatten_sfdc_record(record)
+
+                # the columns come from the first record, as sfdx does;
+                # relationships that are null there show as a single column
+                if (header == None):
+                    header = list(fields.keys())
+                    f.write(",".join(header) + "\n")
+                    yield header
+
+                row = [fields.get(k, "") for k in header]
+                csvWriter.writerow(row)
+                yield row
+    finally:
+        # stops the page loader when the query is closed early
+        stopped.set()
 
 
 #####################################################################
-## Downloads the given Quip document
+## Requests one page of Salesforce REST query results
 #####################################################################
-def get_quip_doc(accessToken, docId):
-    client = quip.QuipClient(access_token=accessToken)
+def sfdc_rest_get(url, accessToken):
+    import urllib.request
+    request = urllib.request.Request(url, headers={ "Authorization": "Bearer " + accessToken, "Accept": "application/json" })
+    try:
+        with urllib.request.urlopen(request, timeout=SFDC_REQUEST_TIMEOUT) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        raise SearchError("HTTP " + str(e.code) + " " + e.read().decode("utf-8", "replace"))
+
+
+#####################################################################
+## Flattens a Salesforce REST record into column name and value pairs,
+## naming relationship fields with dots (Owner.Name) like sfdx does
+#####################################################################
+def flatten_sfdc_record(record, prefix=""):
+    fields = dict()
+    for key, value in record.items():
+        if (key == "attributes"):
+            continue
+        if (isinstance(value, dict)):
+            fields.update(flatten_sfdc_record(value, prefix + key + "."))
+        elif (value == None):
+            fields[prefix + key] = ""
+        elif (isinstance(value, bool)):
+            fields[prefix + key] = "true" if value else "false"
+        else:
+            fields[prefix + key] = str(value)
+    return fields
+
+
+#####################################################################
+## Parses SOQL CSV output lines into the header and account rows
+#####################################################################
+def read_soql_rows(lines):
+    header = next(lines, None)
+    if (header == None):
+        return
+
+    yield header.rstrip("\n").split(",")
+
+    for row in csv.reader(lines, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL, skipinitialspace=True):
+        yield row
+
+
+#####################################################################
+## Extracts the Quip document ID from a Quip URL.  Any query string or
+## fragment is dropped, so links to the same doc share one ID.
+#####################################################################
+def get_quip_doc_id(quipUrlStrip, url):
+    u = url.strip().replace(quipUrlStrip, "")
+    u = u.split("#", 1)[0].split("?", 1)[0]
+    t = u.split("/", 1)
+    if (len(t) > 1):
+        return t[0]
+    return u
+
+
+#####################################################################
+## Bulk downloads every uncached document of the given doc IDs and
+## caches it.  With refresh, cached documents that changed in Quip
+## since they were cached are downloaded again as well, leaving out
+## those in checked, the doc IDs already downloaded or checked this
+## run, which the documents handled here are added to.  Failures are
+## remembered for their category's TTL, and documents that failed
+## within it are skipped rather than requested again.  Returns each
+## download failure keyed by doc ID so that the failures can be
+## reported per account.
+#####################################################################
+def prefetch_quip_docs(executor, cache, client, docIds, bulkSize, refresh, checked, failureTtls):
+    fetch = []
+    check = []
+    known = dict()
+    for docId in docIds:
+        if (not cache.contains(docId)):
+            failure = cache.get_failure(docId)
+            if (failure != None) and (time.time() - failure["failed"] < failureTtls.get(failure["category"], 0)):
+                metrics.add("known_failures_skipped")
+                failure["skipped"] = True
+                known[docId] = failure
+                continue
+
+            metrics.add("doc_cache_misses")
+            fetch.append(docId)
+            continue
+
+        metrics.add("doc_cache_hits")
+        if (refresh) and (docId not in checked):
+            info = cache.get_info(docId)
+            if (info == None):
+                fetch.append(docId)
+            else:
+                check.append((docId, info["updatedUsec"]))
+
+    if (refresh):
+        checked.update(fetch)
+        checked.update(c[0] for c in check)
+
+    if (len(check) > 0):
+        print ("Checking " + str(len(check)) + " cached documents for changes...")
+        changed = get_quip_docs_changed(executor, client, check)
+        print (str(len(changed)) + " cached documents have changed")
+
+        metrics.add("docs_refreshed", len(changed))
+        fetch.extend(changed)
+
+    if (len(known) > 0):
+        print ("Skipping " + str(len(known)) + " documents that failed recently")
+
+    if (len(fetch) == 0):
+        return known
+
+    print ("Bulk downloading " + str(len(fetch)) + " Quip documents...")
+    docs, errors = get_quip_docs(executor, client, fetch, bulkSize)
+    print ("Downloaded " + str(len(docs)) + " Quip documents, " + str(len(errors)) + " failed")
+
+    metrics.add("docs_downloaded", len(docs))
+    metrics.add("docs_failed", len(errors))
+    for docId, thread in docs.items():
+        metrics.add("downloaded_bytes", len(thread['html'].encode("utf-8")))
+        with metrics.timer("cache_write"):
+            cache.put(docId, thread['html'], thread['thread']['updated_usec'])
+
+    failures = dict((docId, get_fetch_error(e)) for docId, e in errors.items())
+    for docId, failure in failures.items():
+        if (failureTtls.get(failure["category"], 0) > 0):
+            cache.put_failure(docId, failure)
+
+    failures.update(known)
+    return failures
+
+
+#####################################################################
+## Reads how long failures of each category are remembered, in
+## seconds, from the FAILURE_TTL_<CATEGORY> settings
+#####################################################################
+def get_failure_ttls(config):
+    failureTtls = dict()
+    for category, ttl in DEFAULT_FAILURE_TTLS.items():
+        failureTtls[category] = int(config.get(CONFIG_KEY_FAILURE_TTL_PREFIX + category.upper(), ttl))
+    return failureTtls
+
+
+#####################################################################
+## Returns the doc IDs of the given cached Quip documents, as (doc
+## ID, cached updated_usec) pairs, that have changed since they were
+## cached.  Each document's metadata is read on the executor, without
+## its HTML, so a check costs one small request per document, paced
+## by the client like every other request.  Documents whose metadata
+## can't be read keep being used from the cache.
+#####################################################################
+def get_quip_docs_changed(executor, client, check):
+    futures = [(docId, updatedUsec, executor.submit(client.get_thread_metadata, docId)) for docId, updatedUsec in check]
+
+    changed = []
+    for docId, updatedUsec, future in futures:
+        try:
+            thread = future.result()
+        except Exception as e:
+            print ("Unable to check Quip document for changes, using cached copy!  DocID=" + docId + " Error=" + str(e))
+            continue
+        if (thread['thread']['updated_usec'] > updatedUsec):
+            changed.append(docId)
+
+    return changed
+
+
+#####################################################################
+## Downloads the given Quip documents in chunks through the bulk
+## threads endpoint, running the chunks on the executor.  Chunks that
+## fail or come back partial are split until each remaining document
+## is pulled on its own, so one bad document cannot sink the rest of
+## its chunk.
+#####################################################################
+def get_quip_docs(executor, client, docIds, bulkSize):
+    docs = dict()
+    errors = dict()
+    pending = set()
+    for i in range(0, len(docIds), bulkSize):
+        pending.add(executor.submit(get_quip_chunk, client, docIds[i:i + bulkSize]))
+
+    while (len(pending) > 0):
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            chunkDocs, chunkErrors, retryChunks = future.result()
+            docs.update(chunkDocs)
+            errors.update(chunkErrors)
+            for chunk in retryChunks:
+                pending.add(executor.submit(get_quip_chunk, client, chunk))
+
+    return docs, errors
+
+
+#####################################################################
+## Downloads a single chunk of Quip documents.  Returns the threads
+## and errors keyed by doc ID, plus the chunks that need another try.
+#####################################################################
+def get_quip_chunk(client, chunk):
+    docs = dict()
+    errors = dict()
+
+    if (len(chunk) == 1):
+        docId = chunk[0]
+        try:
+            with metrics.timer("quip_request"):
+                docs[docId] = client.get_thread(id=docId)
+        except (http.client.InvalidURL, quip.QuipError, urllib.error.HTTPError, TimeoutError) as e:
+            metrics.error(e)
+            errors[docId] = e
+        return docs, errors, []
+
+    try:
+        with metrics.timer("quip_request"):
+            threads = client.get_threads(ids=chunk)
+    except (quip.QuipError, urllib.error.HTTPError, TimeoutError) as e:
+        metrics.error(e)
+        threads = dict()
+
+    missing = []
+    for docId in chunk:
+        thread = find_quip_thread(threads, docId)
+        if (thread != None) and ('html' in thread):
+            docs[docId] = thread
+        else:
+            missing.append(docId)
+
+    if (len(missing) == len(chunk)):
+        half = len(chunk) // 2
+        return docs, errors, [chunk[:half], chunk[half:]]
+    elif (len(missing) > 0):
+        return docs, errors, [missing]
+
+    return docs, errors, []
+
+
+#####################################################################
+## Finds the thread for the given doc ID in a bulk threads response,
+## which may be keyed by thread ID rather than the URL doc ID
+#####################################################################
+def find_quip_thread(threads, docId):
+    if (docId in threads):
+        return threads[docId]
+
+    for thread in threads.values():
+        info = thread.get('thread', dict())
+        if (info.get('id') == docId) or (info.get('link', "").endswith("/" + docId)):
+            return thread
+
+    return None
+
+
+#####################################################################
+## Imports the Quip client on first use, since it pulls in ssl and
+## http.client, which make up most of search.py's startup time.  Every Quip
+## call goes through a client made after this has run.
+#####################################################################
+quip = None
+
+def load_quip():
+    global quip
+    import quip
+
+
+#####################################################################
+## Creates the Quip client shared by the whole run
+#####################################################################
+def get_quip_client(accessToken, baseUrl=None):
+    load_quip()
+    client = quip.QuipClient(access_token=accessToken, base_url=baseUrl)
     user = client.get_authenticated_user()
 
-    thread = client.get_thread(id=docId)
-    return thread['html']
+    return client
+
+
+#####################################################################
+## Downloads the given Quip document
+#####################################################################
+def get_quip_doc(client, docId):
+    return client.get_thread(id=docId)
 
 
 #####################################################################
 ## Search a given Quip document for a keyword
 #####################################################################
 def search_quip(accessToken, searchTerm, testDocId):
+    load_quip()
     client = quip.QuipClient(access_token=accessToken)
     user = client.get_authenticated_user()
 
@@ -317,6 +2693,50 @@ def search_quip(accessToken, searchTerm, testDocId):
     print (threadSearch)
 
 
+#####################################################################
+##  Splits command line options from search terms
+#####################################################################
+def parse_options(args):
+    options = dict()
+    searchTerms = []
+
+    i = 0
+    while (i < len(args)):
+        arg = args[i]
+        if (arg in [ OPTION_REFRESH, OPTION_REFRESH_SOQL, OPTION_RESUME, OPTION_PROFILE ]):
+            options[arg] = True
+            i += 1
+        elif (arg in [ OPTION_WORKERS, OPTION_PROCESSES, OPTION_INDEX, OPTION_SHARD, OPTION_MERGE, OPTION_FORMAT ]):
+            if (i + 1 >= len(args)):
+                print ("Option requires a value: " + arg)
+                sys.exit()
+            options[arg] = args[i + 1]
+            i += 2
+        else:
+            searchTerms.append(arg)
+            i += 1
+
+    return options, searchTerms
+
+
+#####################################################################
+##  Parses a --shard value, e.g. 2/4 for the second of four shards,
+##  returning None when the accounts aren't sharded
+#####################################################################
+def parse_shard(value):
+    if (value == None):
+        return None
+
+    try:
+        shardIndex, shardCount = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise SearchError("Invalid shard!  Expected <i>/<n> and received: " + value)
+    if (shardIndex < 1) or (shardIndex > shardCount):
+        raise SearchError("Invalid shard!  Expected 1 <= i <= n and received: " + value)
+
+    return (shardIndex, shardCount)
+
+
 #####################################################################
 ##  Load configuration from config file, stored outside of git
 #####################################################################
@@ -354,4 +2774,5 @@ def load_config():
 #####################################################################
 ##  Program Entry Point
 #####################################################################
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import unittest
+
+import search
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+
+#####################################################################
+## Documents covering the markup the extractors have to handle the
+## way BeautifulSoup's get_text does
+#####################################################################
+DOCUMENTS = {
+    "plain": "<h1>Title</h1><p>Some <b>bold</b> text</p>",
+    "entities": "<p>Fish &amp; Chips &lt;kube&gt; &copy; &nbsp;&notanentity; &amp</p>",
+    "charrefs": "<p>&#233;cole &#xE9;cole &#x1F600; &#128512; &#0; &#x110000; &#150;</p>",
+    "cdata": "<p>before <![CDATA[ kube <b>not bold</b> ]]> after</p>",
+    "void tags": "<p>one<br>two<br/>three<img src=x>four<hr><input value=five>six</p>",
+    "unmatched end tags": "<p>one</b></i>two</div></p></p>three<span>four",
+    "pre whitespace": "<pre>\n  indented\n\n    kube   \n</pre><p>   </p><p>\n\n</p>",
+    "textarea whitespace": "<textarea>  \n  </textarea><div>  \n  </div>",
+    "script": "<script>\n  var kube = '<b>' + 1;\n</script><p>text</p>",
+    "style": "<style>  p { color: red }  </style><p>text</p>",
+    "comments": "<p>one<!-- kube -->two<!DOCTYPE html><?pi data?>three</p>",
+    "nested": "<ul><li>one<ul><li>two</li></ul></li><li>three</li></ul><table><tr><td>a</td><td>b</td></tr></table>",
+}
+
+
+#####################################################################
+## Checks each text extractor against BeautifulSoup's get_text with
+## the parser it follows
+#####################################################################
+@unittest.skipIf(BeautifulSoup == None, "beautifulsoup4 is not installed")
+class ExtractTextParityTest(unittest.TestCase):
+    def test_stream(self):
+        for name, html in DOCUMENTS.items():
+            with self.subTest(name):
+                expected = BeautifulSoup(html, features="html.parser").get_text()
+                self.assertEqual(search.extract_text_stream(html), expected)
+
+    @unittest.skipIf(lxml == None, "lxml is not installed")
+    def test_lxml(self):
+        for name, html in DOCUMENTS.items():
+            with self.subTest(name):
+                expected = BeautifulSoup(html, features="lxml").get_text()
+                self.assertEqual(search.extract_text_lxml(html), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()